@@ -0,0 +1,96 @@
+import logging
+import os
+from typing import Dict
+from urllib.parse import urlsplit
+
+import httpx
+
+from backend.api.core.exchanges_clients import ExchangeClient, KuCoinClient, MexcClient
+from backend.api.models.crypto import Exchange
+
+logger = logging.getLogger(__name__)
+
+EXCHANGE_HTTP2 = os.environ.get("EXCHANGE_HTTP2", "false").lower() == "true"
+EXCHANGE_MAX_CONNECTIONS = int(os.environ.get("EXCHANGE_MAX_CONNECTIONS", 10))
+EXCHANGE_KEEPALIVE_EXPIRY = float(os.environ.get("EXCHANGE_KEEPALIVE_EXPIRY", 120))
+
+CLIENT_CLASSES = {
+    "KuCoin": KuCoinClient,
+    "MEXC": MexcClient,
+}
+
+
+def http2_available() -> bool:
+    try:
+        import h2  # noqa: F401
+    except ImportError:
+        return False
+    return True
+
+
+class ExchangeClientRegistry:
+    # one pooled keep-alive httpx.Client per exchange host, shared by all the
+    # exchange clients of the process so TLS sessions are reused across tasks
+
+    def __init__(self, http2: bool = EXCHANGE_HTTP2):
+        if http2 and not http2_available():
+            logger.warning("h2 is not installed, exchange clients use HTTP/1.1")
+            http2 = False
+        self.http2 = http2
+        self.http_clients: Dict[str, httpx.Client] = {}
+        self.clients: Dict[str, ExchangeClient] = {}
+        self.requests: Dict[str, int] = {}
+
+    def http_client(self, base_url: str) -> httpx.Client:
+        host = urlsplit(str(base_url)).netloc
+        if host not in self.http_clients:
+            self.requests[host] = 0
+
+            def count_request(request):
+                self.requests[host] += 1
+
+            self.http_clients[host] = httpx.Client(
+                http2=self.http2,
+                limits=httpx.Limits(
+                    max_connections=EXCHANGE_MAX_CONNECTIONS,
+                    max_keepalive_connections=EXCHANGE_MAX_CONNECTIONS,
+                    keepalive_expiry=EXCHANGE_KEEPALIVE_EXPIRY,
+                ),
+                event_hooks={"request": [count_request]},
+            )
+        return self.http_clients[host]
+
+    def get(self, exchange: Exchange) -> ExchangeClient:
+        if exchange.name not in self.clients:
+            client_class = CLIENT_CLASSES[exchange.name]
+            self.clients[exchange.name] = client_class(
+                id=exchange.id,
+                name=exchange.name,
+                api_key=exchange.api_key,
+                api_secret=exchange.secret_key,
+                passphrase=exchange.passphrase,
+                base_url=exchange.base_url,
+                client=self.http_client(exchange.base_url),
+            )
+        return self.clients[exchange.name]
+
+    def stats(self) -> Dict[str, dict]:
+        stats = {}
+        for host, client in self.http_clients.items():
+            # httpx does not expose its pool, read it from the httpcore transport
+            pool = getattr(client._transport, "_pool", None)
+            connections = pool.connections if pool is not None else []
+            stats[host] = {
+                "http2": self.http2,
+                "requests": self.requests[host],
+                "connections": len(connections),
+                "idle_connections": len([c for c in connections if c.is_idle()]),
+            }
+        return stats
+
+    def close(self):
+        for host, client in self.http_clients.items():
+            logger.info(f"closing exchange connections to {host}")
+            client.close()
+        self.http_clients = {}
+        self.clients = {}
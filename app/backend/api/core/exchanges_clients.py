@@ -1,19 +1,37 @@
+import asyncio
 import base64
+from concurrent.futures import ThreadPoolExecutor, as_completed, wait
 from dataclasses import dataclass
-from datetime import datetime
 import hashlib
 import hmac
 import json
 import logging
 import time
 from enum import Enum
-from typing import List
-from fastapi import HTTPException
+from typing import Dict, List, Set, Tuple
 
 import httpx
 from abc import ABC, abstractmethod
+from backend.api.core.kline_arrays import (
+    KlineArrays,
+    decode_kucoin_klines,
+    decode_mexc_klines,
+)
+from backend.api.core.kline_planner import KlineRangePlanner
+from backend.api.core.price_cache import STREAM_PRICES_KEY, PriceCache
+from backend.api.core.rate_limiter import RATE_LIMIT_RETRIES, RateLimiter
+from backend.api.core.resilience import (
+    ExchangeAPIError,
+    ExchangeError,
+    backoff_delay,
+    get_circuit_breaker,
+    hedge_delay,
+    is_retryable,
+    retries_for,
+    stale_key,
+    timeout_for,
+)
 from backend.api.crypto_manager.account import Account, Balance, Trade
-from backend.api.models.crypto import Kline, Symbol
 
 from backend.config import CRYPTO_RANK_API_KEY, CRYPTO_RANK_BASE_ENDPOINT
 
@@ -22,7 +40,11 @@ import logging
 logger = logging.getLogger(__name__)
 
 
-class ExchangeClient(ABC):
+class BaseExchangeClient(ABC):
+    # Everything the sync and async clients share and that does no I/O:
+    # configuration, signing hooks, the retry and stale data decisions. The
+    # transports only differ in how they send and wait.
+
     def __init__(
         self,
         id: int,
@@ -31,6 +53,7 @@ class ExchangeClient(ABC):
         api_secret: str,
         base_url: str,
         passphrase: str = None,
+        client: httpx.Client | httpx.AsyncClient = None,
     ):
         self.id = id
         self.name = name
@@ -38,7 +61,18 @@ class ExchangeClient(ABC):
         self.api_secret = api_secret
         self.base_url = str(base_url)
         self.passphrase = passphrase
-        self.client = httpx.Client()
+        self.client = client or self.build_client()
+        self.rate_limiter = RateLimiter(name)
+        self.price_cache = PriceCache(stream_key=STREAM_PRICES_KEY.format(name))
+        self.planner = KlineRangePlanner(name)
+        self.circuit_breaker = get_circuit_breaker(name)
+        # last good answer of the STALE_ENDPOINTS, served while the exchange fails
+        self.stale_responses: Dict[tuple, httpx.Response] = {}
+        self.hedge_executor = None
+
+    @abstractmethod
+    def build_client(self):
+        pass
 
     @abstractmethod
     def prepare_headers(self, *args, **kwargs):
@@ -48,42 +82,280 @@ class ExchangeClient(ABC):
     def parse_symbol_exchange(self, *args, **kwargs):
         pass
 
-    def get(self, endpoint, headers: dict, params=None):
-        return self.client.request(
-            "GET", self.base_url + endpoint, params=params, headers=headers
+    def settle(
+        self, endpoint, attempt: int, retries: int, r=None, error=None
+    ) -> httpx.Response | None:
+        """the answer of an attempt, None when it has to be retried. Transport
+        errors and 5xx answers count against the circuit breaker"""
+        if error is None and not is_retryable(r):
+            self.circuit_breaker.record_success()
+            return r
+        self.circuit_breaker.record_failure()
+        if attempt == retries:
+            if error is not None:
+                raise error
+            raise ExchangeAPIError(self.name, endpoint, r)
+        reason = (
+            f"failed: {error!r}" if error is not None else f"answered {r.status_code}"
         )
-
-    def post(self, endpoint, headers: dict, params=None, json=None):
-        return self.client.request(
-            "POST",
-            self.base_url + endpoint,
-            params=params,
-            headers=headers,
-            json=json,
+        logger.warning(f"{self.name} {endpoint} {reason}, retrying")
+        return None
+
+    def stale_or_raise(self, endpoint, key, error: Exception) -> httpx.Response:
+        # last good answer of the STALE_ENDPOINTS, served while the exchange fails
+        if key not in self.stale_responses:
+            raise error
+        logger.warning(
+            f"{self.name} {endpoint} unavailable ({error}), serving stale data"
         )
+        return self.stale_responses[key]
+
+    def remember(self, key, r: httpx.Response) -> httpx.Response:
+        if key is not None and r.status_code == 200:
+            self.stale_responses[key] = r
+        return r
+
+    def checked(self, endpoint: str, r: httpx.Response) -> httpx.Response:
+        # errors below 500 are passed through by resilient_send, an error
+        # body (signature, ip whitelist) must not be parsed as data
+        if not r.is_success:
+            raise ExchangeAPIError(self.name, endpoint, r)
+        return r
+
+    def filter_prices(self, prices: Dict[str, str], keys: List[str] = None):
+        if keys is None:
+            return prices
+        return {k: prices[k] for k in keys if k in prices}
 
     def map_interval(self, interval: str):
         for k in self.KLINE_INTERVALS:
             if k.value == interval:
                 return k.name
 
-    def calculate_expected_klines(self, start_date, end_date, interval) -> int:
-        delta = datetime.fromtimestamp(start_date) - datetime.fromtimestamp(end_date)
-        total_seconds = delta.total_seconds()
-        logger.info(f"total_seconds {total_seconds}")
-        expected_klines = delta.total_seconds() / 60
-        match self.map_interval(interval):
-            case GENERAL_KLINE_INTERVALS.ONE_HOUR.value:
-                ek = expected_klines / 60
-            case GENERAL_KLINE_INTERVALS.FOUR_HOURS.value:
-                ek = expected_klines / 240
-            case GENERAL_KLINE_INTERVALS.ONE_DAY.value:
-                ek = expected_klines / 1440
-            case GENERAL_KLINE_INTERVALS.ONE_WEEK.value:
-                ek = expected_klines / 10080
-            case _:
-                raise HTTPException(400, "Invalid Interval")
-        return int(ek)
+    def kline_windows(
+        self, interval: str, start_at: int, end_at: int
+    ) -> List[Tuple[int, int]]:
+        # the range may come in either order, windows are [start, end)
+        start_at, end_at = sorted((start_at, end_at))
+        return self.planner.plan(interval, start_at, end_at)
+
+
+class ExchangeClient(BaseExchangeClient):
+    # blocking transport, httpx.Client
+
+    def build_client(self):
+        return httpx.Client()
+
+    def send(self, method, endpoint, headers: dict, params=None, json=None):
+        # every request waits for its weight in the exchange budget, a 429
+        # that still gets through is waited out and the request is queued again
+        for _ in range(RATE_LIMIT_RETRIES):
+            self.rate_limiter.acquire(endpoint)
+            r = self.client.request(
+                method,
+                self.base_url + endpoint,
+                params=params,
+                headers=headers,
+                json=json,
+                timeout=timeout_for(self.name, endpoint),
+            )
+            if r.status_code != 429:
+                return r
+            time.sleep(self.rate_limiter.retry_after(r))
+        return r
+
+    def hedged_send(self, method, endpoint, headers: dict, params=None, json=None):
+        # a second copy of a slow GET is sent after the hedge delay and the
+        # first answer wins, the other one is left to finish in the pool
+        delay = hedge_delay(self.name, method, endpoint)
+        if delay is None:
+            return self.send(method, endpoint, headers, params, json)
+        if self.hedge_executor is None:
+            self.hedge_executor = ThreadPoolExecutor(max_workers=4)
+        args = (method, endpoint, headers, params, json)
+        pending = {self.hedge_executor.submit(self.send, *args)}
+        done, pending = wait(pending, timeout=delay)
+        if not done:
+            logger.debug(f"{self.name} {endpoint} slower than {delay}s, hedging")
+            pending.add(self.hedge_executor.submit(self.send, *args))
+        error = None
+        for future in as_completed(done | pending):
+            try:
+                return future.result()
+            except httpx.TransportError as e:
+                error = e
+        raise error
+
+    def resilient_send(self, method, endpoint, headers: dict, params=None, json=None):
+        # idempotent GETs are retried with jittered backoff
+        probe = self.circuit_breaker.check()
+        retries = retries_for(method)
+        try:
+            for attempt in range(retries + 1):
+                try:
+                    r = self.hedged_send(method, endpoint, headers, params, json)
+                except httpx.TransportError as e:
+                    r = self.settle(endpoint, attempt, retries, error=e)
+                else:
+                    r = self.settle(endpoint, attempt, retries, r)
+                if r is not None:
+                    return r
+                time.sleep(backoff_delay(attempt))
+                probe = self.circuit_breaker.check() or probe
+        finally:
+            # any other exception must not leave the circuit probing forever
+            if probe:
+                self.circuit_breaker.release()
+
+    def request(self, method, endpoint, headers: dict, params=None, json=None):
+        key = stale_key(endpoint, params) if method == "GET" else None
+        try:
+            r = self.resilient_send(method, endpoint, headers, params, json)
+        except (ExchangeError, httpx.TransportError) as e:
+            return self.stale_or_raise(endpoint, key, e)
+        return self.remember(key, r)
+
+    def get(self, endpoint, headers: dict, params=None):
+        return self.request("GET", endpoint, headers=headers, params=params)
+
+    def post(self, endpoint, headers: dict, params=None, json=None):
+        return self.request("POST", endpoint, headers=headers, params=params, json=json)
+
+    def get_symbol_kline_window_arrays(self, symbol, interval, window) -> KlineArrays:
+        endpoint, headers, params = self.kline_request(symbol, interval, window)
+        r = self.get(endpoint, headers=headers, params=params)
+        # an error answer would read as "no klines in this window"
+        return self.decode_klines(self.checked(endpoint, r))
+
+    def get_symbol_kline_arrays(
+        self, symbol, interval, start_at, end_at, concurrency: int = 1
+    ) -> KlineArrays:
+        # all the windows are known up front, so with concurrency above 1
+        # they are downloaded in parallel, ascending by time once joined
+        windows = self.kline_windows(interval, start_at, end_at)
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            parts = list(
+                executor.map(
+                    lambda window: self.get_symbol_kline_window_arrays(
+                        symbol, interval, window
+                    ),
+                    windows,
+                )
+            )
+        return KlineArrays.concat(parts)
+
+
+class AsyncExchangeClient(BaseExchangeClient):
+    # same signing and parsing as the sync clients, but requests go through
+    # httpx.AsyncClient so calls to several exchanges can run concurrently.
+    # It does not derive from ExchangeClient, no blocking request method can
+    # be inherited and called without await by mistake.
+
+    def build_client(self):
+        return httpx.AsyncClient()
+
+    async def send(self, method, endpoint, headers: dict, params=None, json=None):
+        for _ in range(RATE_LIMIT_RETRIES):
+            await self.rate_limiter.acquire_async(endpoint)
+            r = await self.client.request(
+                method,
+                self.base_url + endpoint,
+                params=params,
+                headers=headers,
+                json=json,
+                timeout=timeout_for(self.name, endpoint),
+            )
+            if r.status_code != 429:
+                return r
+            await asyncio.sleep(self.rate_limiter.retry_after(r))
+        return r
+
+    async def hedged_send(
+        self, method, endpoint, headers: dict, params=None, json=None
+    ):
+        delay = hedge_delay(self.name, method, endpoint)
+        if delay is None:
+            return await self.send(method, endpoint, headers, params, json)
+        args = (method, endpoint, headers, params, json)
+        pending = {asyncio.create_task(self.send(*args))}
+        done, pending = await asyncio.wait(pending, timeout=delay)
+        if not done:
+            logger.debug(f"{self.name} {endpoint} slower than {delay}s, hedging")
+            pending.add(asyncio.create_task(self.send(*args)))
+        error = None
+        try:
+            for future in asyncio.as_completed(done | pending):
+                try:
+                    return await future
+                except httpx.TransportError as e:
+                    error = e
+            raise error
+        finally:
+            # unlike threads the losing request can be cancelled
+            for task in pending:
+                task.cancel()
+
+    async def resilient_send(
+        self, method, endpoint, headers: dict, params=None, json=None
+    ):
+        probe = self.circuit_breaker.check()
+        retries = retries_for(method)
+        try:
+            for attempt in range(retries + 1):
+                try:
+                    r = await self.hedged_send(method, endpoint, headers, params, json)
+                except httpx.TransportError as e:
+                    r = self.settle(endpoint, attempt, retries, error=e)
+                else:
+                    r = self.settle(endpoint, attempt, retries, r)
+                if r is not None:
+                    return r
+                await asyncio.sleep(backoff_delay(attempt))
+                probe = self.circuit_breaker.check() or probe
+        finally:
+            if probe:
+                self.circuit_breaker.release()
+
+    async def request(self, method, endpoint, headers: dict, params=None, json=None):
+        key = stale_key(endpoint, params) if method == "GET" else None
+        try:
+            r = await self.resilient_send(method, endpoint, headers, params, json)
+        except (ExchangeError, httpx.TransportError) as e:
+            return self.stale_or_raise(endpoint, key, e)
+        return self.remember(key, r)
+
+    async def get(self, endpoint, headers: dict, params=None):
+        return await self.request("GET", endpoint, headers=headers, params=params)
+
+    async def post(self, endpoint, headers: dict, params=None, json=None):
+        return await self.request(
+            "POST", endpoint, headers=headers, params=params, json=json
+        )
+
+    async def get_symbol_kline_window_arrays(
+        self, symbol, interval, window
+    ) -> KlineArrays:
+        endpoint, headers, params = self.kline_request(symbol, interval, window)
+        r = await self.get(endpoint, headers=headers, params=params)
+        return self.decode_klines(self.checked(endpoint, r))
+
+    async def get_symbol_kline_arrays(
+        self, symbol, interval, start_at, end_at, concurrency: int = 1
+    ) -> KlineArrays:
+        windows = self.kline_windows(interval, start_at, end_at)
+        semaphore = asyncio.Semaphore(concurrency)
+
+        async def get_window(window):
+            async with semaphore:
+                return await self.get_symbol_kline_window_arrays(
+                    symbol, interval, window
+                )
+
+        parts = await asyncio.gather(*[get_window(window) for window in windows])
+        return KlineArrays.concat(parts)
+
+    async def aclose(self):
+        await self.client.aclose()
 
 
 class GENERAL_KLINE_INTERVALS(Enum):
@@ -98,7 +370,9 @@ class GENERAL_KLINE_INTERVALS(Enum):
     ONE_MONTH = "ONE_MONTH"
 
 
-class MexcClient(ExchangeClient):
+class MexcApi:
+    # mexc signing, request parameters and parsing, shared by both clients
+
     class KLINE_INTERVALS(Enum):
         ONE_MINUTE = "1m"
         FIVE_MINUTES = "5m"
@@ -149,10 +423,7 @@ class MexcClient(ExchangeClient):
         ).hexdigest()
         return signature
 
-    def get_all_symbols(self):
-        headers = self.prepare_headers()
-        r = self.get("/api/v3/defaultSymbols", headers=headers)
-        r_json = r.json()
+    def parse_all_symbols(self, r_json):
         results = {}
         for symbol_raw in r_json["data"]:
             symbol, base_asset = self.parse_symbol_exchange(symbol_raw)
@@ -160,80 +431,95 @@ class MexcClient(ExchangeClient):
             results[symbol] = base_asset
         return results
 
+    def parse_symbol_pairs(self, r_json) -> Set[Tuple[str, str]]:
+        symbol_pairs = set()
+        for symbol_raw in r_json["data"]:
+            parsed = self.parse_symbol_exchange(symbol_raw)
+            if parsed:
+                symbol_pairs.add(parsed)
+        return symbol_pairs
+
     def parse_symbol_exchange(self, symbol_raw):
+        # the quote asset is the suffix, longest first so USDT wins over DAI
         bases = ["BTC", "ETH", "USDT", "USDC", "USDK", "BNB", "BUSD", "DAI", "TUSD"]
-        for base in bases:
-            if base in symbol_raw:
-                return symbol_raw.strip(base), base
+        for base in sorted(bases, key=len, reverse=True):
+            if symbol_raw.endswith(base) and symbol_raw != base:
+                return symbol_raw[: -len(base)], base
 
-    def get_account_summary(self):
-        endpoint = "/api/v3/account"
-        headers = self.prepare_headers()
+    def signed_params(self):
         timestamp = str(int(time.time() * 1000))
         query_string = f"timestamp={timestamp}"
         signature = self.get_signature_request(query_string=query_string)
-        params = {"timestamp": timestamp, "signature": signature}
-        r = self.get(endpoint, headers=headers, params=params)
-        return r.json()
+        return {"timestamp": timestamp, "signature": signature}
 
-    def get_all_orders(self):
-        endpoint = "/api/v3/allOrders"
-        headers = self.prepare_headers()
-        timestamp = str(int(time.time() * 1000))
-        query_string = f"timestamp={timestamp}"
-        signature = self.get_signature_request(query_string=query_string)
-        params = {"timestamp": timestamp, "signature": signature}
-        r = self.get(endpoint, headers=headers, params=params)
-        return r.json()
+    def kline_request(self, symbol, interval, window):
+        return (
+            "/api/v3/klines",
+            self.prepare_headers(),
+            self.kline_params(symbol, interval, window),
+        )
 
-    def get_symbol_kline(
-        self, symbol, interval, expected_klines, start_at, end_at
-    ) -> List[Kline] | None:
-        endpoint = "/api/v3/klines"
-        """
-        Parameters:
-            Name	Type	Mandatory	Description
-            symbol	string	YES	
-            interval	ENUM	YES	ENUM: Kline Interval
-            startTime	long	NO	
-            endTime	long	NO	
-            limit	integer	NO	Default 500; max 1000.
-        """
-        interval = self.map_interval(interval)
-        params = {
+    def decode_klines(self, r: httpx.Response) -> KlineArrays:
+        return decode_mexc_klines(r.content)
+
+    def kline_params(self, symbol, interval, window):
+        # mexc times are in milliseconds and the end is inclusive
+        return {
             "symbol": symbol,
             "interval": interval,
-            "startTime": start_at * 1000,
-            "endTime": end_at * 1000,
+            "startTime": window[0] * 1000,
+            "endTime": window[1] * 1000 - 1,
+            "limit": self.planner.limit,
         }
+
+    def parse_prices(self, r_json) -> Dict[str, str]:
+        return {ticker["symbol"]: ticker["price"] for ticker in r_json}
+
+    def price_keys(self, symbols: List[str] = None) -> List[str] | None:
+        if symbols is None:
+            return None
+        return [f"{symbol}USDT" for symbol in symbols]
+
+    def build_symbol_pair(self, symbol: str, pair: str):
+        return f"{symbol}{pair}"
+
+
+class MexcClient(MexcApi, ExchangeClient):
+    def get_all_symbols(self):
         headers = self.prepare_headers()
-        r = self.get(endpoint, headers=headers, params=params)
-        r_json = r.json()
-        logger.info(r_json)
-        if r.status_code != 200:
-            return []
-        klines = []
-
-        for kline in r_json:
-            klines.append(
-                Kline(
-                    time=kline[0] / 1000,  # timestamp
-                    open=kline[1],
-                    high=kline[2],
-                    low=kline[3],
-                    close=kline[4],
-                    volume=kline[5],
-                )
-            )
-        return klines
+        r = self.get("/api/v3/defaultSymbols", headers=headers)
+        return self.parse_all_symbols(r.json())
+
+    def get_all_symbols_payload(self) -> bytes:
+        headers = self.prepare_headers()
+        r = self.get("/api/v3/defaultSymbols", headers=headers)
+        return r.content
+
+    def get_account_summary(self):
+        endpoint = "/api/v3/account"
+        headers = self.prepare_headers()
+        params = self.signed_params()
+        r = self.checked(endpoint, self.get(endpoint, headers=headers, params=params))
+        return r.json()
+
+    def get_all_orders(self):
+        endpoint = "/api/v3/allOrders"
+        headers = self.prepare_headers()
+        params = self.signed_params()
+        r = self.checked(endpoint, self.get(endpoint, headers=headers, params=params))
+        return r.json()
 
-    def get_symbol_price(self, symbols=List[str]):
-        symbols = [f"{symbol}USDT" for symbol in symbols]
+    def get_all_prices(self) -> Dict[str, str]:
         endpoint = "/api/v3/ticker/price"
         headers = self.prepare_headers()
         r = self.get(endpoint, headers=headers, params={"symbols": "all"})
-        r_json = r.json()
-        return r_json
+        return self.parse_prices(self.checked(endpoint, r).json())
+
+    def get_symbol_price(self, symbols: List[str] = None) -> Dict[str, str]:
+        # prices by exchange symbol (BTCUSDT), served from the ticker snapshot
+        keys = self.price_keys(symbols)
+        prices = self.price_cache.get(self.get_all_prices, keys)
+        return self.filter_prices(prices, keys)
 
     def get_trades(self, symbol: str):
         endpoint = "/api/v3/trades"
@@ -242,11 +528,57 @@ class MexcClient(ExchangeClient):
         r_json = r.json()
         return r_json
 
-    def build_symbol_pair(self, symbol: Symbol):
-        return f"{symbol.symbol}{symbol.base_asset}"
 
+class AsyncMexcClient(MexcApi, AsyncExchangeClient):
+    async def get_all_symbols(self):
+        headers = self.prepare_headers()
+        r = await self.get("/api/v3/defaultSymbols", headers=headers)
+        return self.parse_all_symbols(r.json())
+
+    async def get_all_symbols_payload(self) -> bytes:
+        headers = self.prepare_headers()
+        r = await self.get("/api/v3/defaultSymbols", headers=headers)
+        return r.content
+
+    async def get_account_summary(self):
+        endpoint = "/api/v3/account"
+        headers = self.prepare_headers()
+        params = self.signed_params()
+        r = self.checked(
+            endpoint, await self.get(endpoint, headers=headers, params=params)
+        )
+        return r.json()
+
+    async def get_all_orders(self):
+        endpoint = "/api/v3/allOrders"
+        headers = self.prepare_headers()
+        params = self.signed_params()
+        r = self.checked(
+            endpoint, await self.get(endpoint, headers=headers, params=params)
+        )
+        return r.json()
+
+    async def get_all_prices(self) -> Dict[str, str]:
+        endpoint = "/api/v3/ticker/price"
+        headers = self.prepare_headers()
+        r = await self.get(endpoint, headers=headers, params={"symbols": "all"})
+        return self.parse_prices(self.checked(endpoint, r).json())
+
+    async def get_symbol_price(self, symbols: List[str] = None) -> Dict[str, str]:
+        keys = self.price_keys(symbols)
+        prices = await self.price_cache.get_async(self.get_all_prices, keys)
+        return self.filter_prices(prices, keys)
+
+    async def get_trades(self, symbol: str):
+        endpoint = "/api/v3/trades"
+        headers = self.prepare_headers()
+        r = await self.get(endpoint, headers=headers, params={"symbol": symbol})
+        return r.json()
+
+
+class KuCoinApi:
+    # kucoin signing, request parameters and parsing, shared by both clients
 
-class KuCoinClient(ExchangeClient):
     class KLINE_INTERVALS(Enum):
         ONE_MINUTE = "1min"
         FIVE_MINUTES = "5min"
@@ -308,19 +640,64 @@ class KuCoinClient(ExchangeClient):
     def parse_symbol_exchange(self, symbol_raw: str):
         return symbol_raw.split("-")[0], symbol_raw.split("-")[1]
 
-    def get_all_symbols(self):
-        headers = self.prepare_headers("/api/v1/symbols")
-        r_data = self.get("/api/v2/symbols", headers=headers)
-        r_json = r_data.json()
+    def parse_all_symbols(self, r_json):
         logger.info(r_json)
         results = {}
         for symbol in r_json["data"]:
             results[symbol["baseCurrency"]] = symbol["quoteCurrency"]
         return results
 
+    def parse_symbol_pairs(self, r_json) -> Set[Tuple[str, str]]:
+        return {
+            (symbol["baseCurrency"], symbol["quoteCurrency"])
+            for symbol in r_json["data"]
+        }
+
     def parse_kucoin_symbol(self, symbol_raw):
         logger.info(symbol_raw)
 
+    def parse_prices(self, r_json) -> Dict[str, str]:
+        return r_json["data"]
+
+    def price_keys(self, symbols: List[str] = None) -> List[str] | None:
+        return symbols
+
+    def kline_request(self, symbol, interval, window):
+        endpoint = "/api/v1/market/candles"
+        return (
+            endpoint,
+            self.prepare_headers(endpoint),
+            self.kline_params(symbol, interval, window),
+        )
+
+    def decode_klines(self, r: httpx.Response) -> KlineArrays:
+        return decode_kucoin_klines(r)
+
+    def kline_params(self, symbol, interval, window):
+        # the end is sent inclusive so the next window's first kline is not
+        # requested twice
+        return {
+            "symbol": symbol,
+            "type": interval,
+            "startAt": window[0],
+            "endAt": window[1] - 1,
+        }
+
+    def build_symbol_pair(self, symbol: str, pair: str):
+        return f"{symbol}-{pair}"
+
+
+class KuCoinClient(KuCoinApi, ExchangeClient):
+    def get_all_symbols(self):
+        headers = self.prepare_headers("/api/v1/symbols")
+        r_data = self.get("/api/v2/symbols", headers=headers)
+        return self.parse_all_symbols(r_data.json())
+
+    def get_all_symbols_payload(self) -> bytes:
+        headers = self.prepare_headers("/api/v1/symbols")
+        r_data = self.get("/api/v2/symbols", headers=headers)
+        return r_data.content
+
     def get_all_orders(self):
         return {}
 
@@ -328,85 +705,23 @@ class KuCoinClient(ExchangeClient):
         """get holdings and balance"""
         endpoint = "/api/v1/accounts"
         headers = self.prepare_headers(endpoint)
-        r_data = self.get(endpoint, headers=headers)
+        r_data = self.checked(endpoint, self.get(endpoint, headers=headers))
         r_json = r_data.json()
         return r_json
 
-    def get_symbol_price(self, symbols: List[str]):
+    def get_all_prices(self) -> Dict[str, str]:
+        # without currencies kucoin returns the price of every currency
         endpoint = "/api/v1/prices"
+        params = {"base": "USD"}
         headers = self.prepare_headers(endpoint)
-        params = {"base": "USD", "currencies": ",".join(symbols)}
         r_data = self.get(endpoint, headers=headers, params=params)
-        r_json = r_data.json()
-        return r_json
+        return self.parse_prices(self.checked(endpoint, r_data).json())
 
-    def get_symbol_kline(
-        self,
-        symbol: str,
-        interval: str,
-        start_at: int = None,
-        end_at: int = None,
-    ) -> List[dict]:
-        # kucoin retuns at most 1500 klines per request
-        params = {}
-        # calculate the expected number of klines
-        logger.info(f"start_at {datetime.fromtimestamp(start_at)}")
-        logger.info(f"end_at {datetime.fromtimestamp(end_at)}")
-        expected_klines = self.calculate_expected_klines(
-            start_date=start_at,
-            end_date=end_at,
-            interval=interval,
-        )
-        logger.info(f"expected_klines {expected_klines}")
-        if expected_klines > 1500:
-            # paginate requests
-            number_of_pages = int(expected_klines // 1500)
-        else:
-            number_of_pages = 1
-
-        klines = []
-        logger.info(number_of_pages)
-        logger.info(expected_klines)
-        for page in range(1, number_of_pages + 1):
-            data = None
-            endpoint = "/api/v1/market/candles"
-            headers = self.prepare_headers(endpoint)
-
-            params["currentPage"] = page
-            params["pageSize"] = 1500
-            params["symbol"] = symbol
-            params["type"] = interval
-            params["startAt"] = end_at
-            params["endAt"] = start_at
-
-            r_data = self.get(
-                endpoint,
-                headers=headers,
-                params=params,
-            )
-            r_json = r_data.json()
-            logger.info(f"status code kucoin: {r_data.status_code}")
-            logger.info(f"response code kucoin: {r_json['code']}")
-
-            if "data" not in r_json.keys():
-                continue
-
-            data = r_json.pop("data")
-            logger.info(f"len data: {len(data)}")
-
-            for kline in data:
-                klines.append(
-                    {
-                        "time": kline[0],
-                        "open": kline[1],
-                        "close": kline[2],
-                        "high": kline[3],
-                        "low": kline[4],
-                        "volume": kline[5],
-                    }
-                )
-            logger.info(len(klines))
-        return klines
+    def get_symbol_price(self, symbols: List[str] = None) -> Dict[str, str]:
+        # USD prices by currency (BTC), served from the ticker snapshot
+        keys = self.price_keys(symbols)
+        prices = self.price_cache.get(self.get_all_prices, keys)
+        return self.filter_prices(prices, keys)
 
     def get_trades(self):
         endpoint = "/api/v1/fills"
@@ -417,8 +732,48 @@ class KuCoinClient(ExchangeClient):
         r_json = r.json()
         return r_json
 
-    def build_symbol_pair(self, symbol: Symbol):
-        return f"{symbol.symbol}-{symbol.base_asset}"
+
+class AsyncKuCoinClient(KuCoinApi, AsyncExchangeClient):
+    async def get_all_symbols(self):
+        headers = self.prepare_headers("/api/v1/symbols")
+        r_data = await self.get("/api/v2/symbols", headers=headers)
+        return self.parse_all_symbols(r_data.json())
+
+    async def get_all_symbols_payload(self) -> bytes:
+        headers = self.prepare_headers("/api/v1/symbols")
+        r_data = await self.get("/api/v2/symbols", headers=headers)
+        return r_data.content
+
+    async def get_all_orders(self):
+        return {}
+
+    async def get_account_summary(self):
+        """get holdings and balance"""
+        endpoint = "/api/v1/accounts"
+        headers = self.prepare_headers(endpoint)
+        r_data = self.checked(endpoint, await self.get(endpoint, headers=headers))
+        return r_data.json()
+
+    async def get_all_prices(self) -> Dict[str, str]:
+        endpoint = "/api/v1/prices"
+        params = {"base": "USD"}
+        headers = self.prepare_headers(endpoint)
+        r_data = await self.get(endpoint, headers=headers, params=params)
+        return self.parse_prices(self.checked(endpoint, r_data).json())
+
+    async def get_symbol_price(self, symbols: List[str] = None) -> Dict[str, str]:
+        keys = self.price_keys(symbols)
+        prices = await self.price_cache.get_async(self.get_all_prices, keys)
+        return self.filter_prices(prices, keys)
+
+    async def get_trades(self):
+        endpoint = "/api/v1/fills"
+        params = {"status": "done"}
+        headers = self.prepare_headers(endpoint, params=params)
+        r = self.checked(
+            endpoint, await self.get(endpoint, headers=headers, params=params)
+        )
+        return r.json()
 
 
 class CryptoRankClient:
@@ -0,0 +1,98 @@
+from dataclasses import dataclass
+from typing import List
+
+import httpx
+import numpy as np
+import orjson
+import pandas as pd
+
+from backend.api.core.resilience import ExchangeAPIError
+
+KLINE_COLUMNS = ["time", "open", "high", "low", "close", "volume"]
+
+
+@dataclass
+class KlineArrays:
+    # one typed column per field instead of one object per kline, time is in
+    # seconds like the klines table
+    time: np.ndarray
+    open: np.ndarray
+    high: np.ndarray
+    low: np.ndarray
+    close: np.ndarray
+    volume: np.ndarray
+
+    def __len__(self):
+        return len(self.time)
+
+    @classmethod
+    def empty(cls) -> "KlineArrays":
+        return cls(
+            time=np.empty(0, dtype=np.int64),
+            **{c: np.empty(0, dtype=np.float64) for c in KLINE_COLUMNS[1:]},
+        )
+
+    @classmethod
+    def concat(cls, parts: List["KlineArrays"], sort: bool = True) -> "KlineArrays":
+        # parts already ascending and disjoint can skip the sort
+        parts = [part for part in parts if len(part)]
+        if not parts:
+            return cls.empty()
+        klines = cls(
+            **{c: np.concatenate([getattr(p, c) for p in parts]) for c in KLINE_COLUMNS}
+        )
+        return klines.sorted() if sort else klines
+
+    def take(self, index: np.ndarray) -> "KlineArrays":
+        return KlineArrays(**{c: getattr(self, c)[index] for c in KLINE_COLUMNS})
+
+    def sorted(self) -> "KlineArrays":
+        # ascending by time, one kline per time (pages overlap on boundaries)
+        _, index = np.unique(self.time, return_index=True)
+        return self.take(index)
+
+    def to_frame(self) -> pd.DataFrame:
+        return pd.DataFrame({c: getattr(self, c) for c in KLINE_COLUMNS})
+
+    def to_rows(self, symbol_id: int, interval_id: int) -> List[dict]:
+        columns = [getattr(self, c).tolist() for c in KLINE_COLUMNS]
+        return [
+            dict(zip(KLINE_COLUMNS, values), symbol_id=symbol_id, interval_id=interval_id)
+            for values in zip(*columns)
+        ]
+
+
+def decode_rows(rows: list, width: int) -> np.ndarray:
+    # the exchanges send numbers as strings, numpy parses them in one pass
+    return np.array(rows, dtype=np.float64).reshape(-1, width)
+
+
+def decode_kucoin_klines(response: httpx.Response) -> KlineArrays:
+    # [time, open, close, high, low, volume, turnover], time in seconds
+    body = orjson.loads(response.content)
+    if body.get("code") != "200000":
+        # an error body is not an empty window, it must not be covered
+        raise ExchangeAPIError("KuCoin", response.url.path, response)
+    rows = decode_rows(body.get("data") or [], 7)
+    return KlineArrays(
+        time=rows[:, 0].astype(np.int64),
+        open=rows[:, 1],
+        high=rows[:, 3],
+        low=rows[:, 4],
+        close=rows[:, 2],
+        volume=rows[:, 5],
+    ).sorted()
+
+
+def decode_mexc_klines(content: bytes) -> KlineArrays:
+    # [open time, open, high, low, close, volume, close time, quote volume],
+    # times in milliseconds
+    rows = decode_rows(orjson.loads(content), 8)
+    return KlineArrays(
+        time=rows[:, 0].astype(np.int64) // 1000,
+        open=rows[:, 1],
+        high=rows[:, 2],
+        low=rows[:, 3],
+        close=rows[:, 4],
+        volume=rows[:, 5],
+    ).sorted()
@@ -0,0 +1,36 @@
+import os
+from datetime import datetime, timezone
+from typing import List
+
+from backend.api.core.kline_coverage import KlineCoverageIndex, Range
+from backend.api.core.kline_planner import KlineRangePlanner
+from backend.api.core.kline_store import KlineSeries
+
+# start of a backfill without start_at, windows before the listing are empty
+KLINE_BACKFILL_FROM = os.environ.get("KLINE_BACKFILL_FROM", "2017-01")
+# request windows downloaded by one backfill subtask
+KLINE_BACKFILL_CHUNK_WINDOWS = int(os.environ.get("KLINE_BACKFILL_CHUNK_WINDOWS", 8))
+KLINE_BACKFILL_RETRIES = int(os.environ.get("KLINE_BACKFILL_RETRIES", 5))
+
+
+def backfill_start() -> int:
+    first = datetime.strptime(KLINE_BACKFILL_FROM, "%Y-%m")
+    return int(first.replace(tzinfo=timezone.utc).timestamp())
+
+
+def backfill_chunks(
+    planner: KlineRangePlanner,
+    coverage: KlineCoverageIndex,
+    series: KlineSeries,
+    start: int,
+    end: int,
+) -> List[Range]:
+    """the missing parts of [start, end) split into independent chunks of
+    KLINE_BACKFILL_CHUNK_WINDOWS request windows, newest first"""
+    chunks = []
+    for gap_start, gap_end in coverage.missing(series, start, end):
+        windows = planner.plan(series.interval, gap_start, gap_end)
+        for i in range(0, len(windows), KLINE_BACKFILL_CHUNK_WINDOWS):
+            last = windows[min(i + KLINE_BACKFILL_CHUNK_WINDOWS, len(windows)) - 1]
+            chunks.append((windows[i][0], last[1]))
+    return chunks[::-1]
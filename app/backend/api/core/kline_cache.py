@@ -0,0 +1,219 @@
+import logging
+import os
+import struct
+import time
+from typing import List
+
+import numpy as np
+import redis
+
+from backend.api.core.kline_arrays import KlineArrays
+from backend.api.core.kline_codec import decode_klines, encode_klines
+from backend.api.core.kline_coverage import KlineCoverageIndex, Range
+from backend.api.core.kline_planner import MONTH, KlineRangePlanner
+from backend.api.core.kline_store import KlineSeries, KlineStore
+from backend.api.core.redis_client import get_redis_client
+
+logger = logging.getLogger(__name__)
+
+KLINE_CACHE = os.environ.get("KLINE_CACHE", "true").lower() == "true"
+KLINE_CACHE_BYTES = int(os.environ.get("KLINE_CACHE_BYTES", 64 * 1024 * 1024))
+# klines per cached block
+KLINE_CACHE_BLOCK = int(os.environ.get("KLINE_CACHE_BLOCK", 1000))
+
+LRU_KEY = "klines:cache:lru"
+SIZES_KEY = "klines:cache:sizes"
+TOTAL_KEY = "klines:cache:bytes"
+# stored span of a block, [start, end)
+SPAN = struct.Struct("<qq")
+
+
+class KlineCache:
+    # Read-through cache of kline blocks in redis. A block spans
+    # KLINE_CACHE_BLOCK candles of one series and holds the klines of its
+    # stored (covered) part, encoded with kline_codec after the span itself,
+    # so a read is served only if the span holds the requested part. The
+    # block with the still open candle expires after one candle. Last access times live in
+    # a sorted set and the least recently used blocks are dropped once the
+    # cached bytes go over KLINE_CACHE_BYTES.
+
+    def __init__(
+        self, redis_client: redis.Redis = None, budget: int = KLINE_CACHE_BYTES
+    ):
+        self.redis = redis_client or get_redis_client()
+        self.budget = budget
+
+    def block_seconds(self, planner: KlineRangePlanner, interval: str) -> int:
+        seconds = planner.interval_seconds(interval)
+        if seconds == MONTH:
+            seconds = 31 * 24 * 60 * 60
+        return seconds * KLINE_CACHE_BLOCK
+
+    def blocks(
+        self, planner: KlineRangePlanner, series: KlineSeries, start: int, end: int
+    ) -> List[int]:
+        """blocks holding the klines opening in [start, end]"""
+        size = self.block_seconds(planner, series.interval)
+        return list(range(start // size * size, end + 1, size))
+
+    def key(self, series: KlineSeries, block: int) -> str:
+        return (
+            f"klines:cache:{series.exchange}:{series.symbol}-{series.pair}:"
+            f"{series.interval}:{block}"
+        )
+
+    def get(
+        self, planner: KlineRangePlanner, series: KlineSeries, start: int, end: int
+    ) -> KlineArrays | None:
+        """klines with start <= time <= end, None unless every block is cached"""
+        blocks = self.blocks(planner, series, start, end)
+        keys = [self.key(series, block) for block in blocks]
+        try:
+            values = self.redis.mget(keys)
+            if any(value is None for value in values):
+                return None
+            self.redis.zadd(LRU_KEY, {key: time.time() for key in keys})
+        except redis.RedisError as e:
+            logger.warning(f"kline cache unavailable: {e}")
+            return None
+        size = self.block_seconds(planner, series.interval)
+        for block, value in zip(blocks, values):
+            span_start, span_end = SPAN.unpack_from(value)
+            if span_start > max(block, start) or span_end < min(block + size, end + 1):
+                return None
+        klines = KlineArrays.concat(
+            [decode_klines(value[SPAN.size :]) for value in values], sort=False
+        )
+        return klines.take((klines.time >= start) & (klines.time <= end))
+
+    def put(
+        self,
+        planner: KlineRangePlanner,
+        series: KlineSeries,
+        klines: KlineArrays,
+        covered: List[Range],
+        start: int,
+        end: int,
+    ):
+        """cache the blocks of [start, end] whose requested part is covered,
+        `klines` holds every stored kline of those blocks"""
+        size = self.block_seconds(planner, series.interval)
+        now = int(time.time())
+        current_open = planner.align(now, series.interval)
+        candle = planner.next_open(current_open, series.interval) - current_open
+        pipeline = self.redis.pipeline()
+        sizes = {}
+        for block in self.blocks(planner, series, start, end):
+            block_end = block + size
+            open_block = block <= current_open < block_end
+            # coverage never holds the open candle, it is stored anyway
+            requested_end = min(block_end, end + 1)
+            if open_block:
+                requested_end = min(requested_end, current_open)
+            requested_start = min(max(block, start), requested_end)
+            span = next(
+                (
+                    (max(block, covered_start), min(block_end, covered_end))
+                    for covered_start, covered_end in covered
+                    if covered_start <= requested_start and covered_end >= requested_end
+                ),
+                None,
+            )
+            if span is None:
+                continue
+            span_start, span_end = span
+            if open_block and span_end >= current_open:
+                span_end = block_end
+            index = (klines.time >= span_start) & (klines.time < span_end)
+            value = SPAN.pack(span_start, span_end) + encode_klines(klines.take(index))
+            key = self.key(series, block)
+            pipeline.set(key, value, ex=candle if open_block else None)
+            sizes[key] = len(value)
+        if not sizes:
+            return
+        pipeline.zadd(LRU_KEY, {key: now for key in sizes})
+        pipeline.hset(SIZES_KEY, mapping=sizes)
+        try:
+            # blocks cached again replace their previous size
+            replaced = self.redis.hmget(SIZES_KEY, list(sizes))
+            pipeline.incrby(
+                TOTAL_KEY, sum(sizes.values()) - sum(int(s) for s in replaced if s)
+            )
+            pipeline.execute()
+            self.evict()
+        except redis.RedisError as e:
+            logger.warning(f"kline cache unavailable: {e}")
+
+    def invalidate(
+        self, planner: KlineRangePlanner, series: KlineSeries, times: np.ndarray
+    ):
+        if not len(times):
+            return
+        size = self.block_seconds(planner, series.interval)
+        keys = [self.key(series, int(b)) for b in np.unique(times // size * size)]
+        try:
+            self.drop(keys)
+        except redis.RedisError as e:
+            logger.warning(f"kline cache unavailable: {e}")
+
+    def drop(self, keys: List[str]):
+        sizes = self.redis.hmget(SIZES_KEY, keys)
+        pipeline = self.redis.pipeline()
+        pipeline.delete(*keys)
+        pipeline.zrem(LRU_KEY, *keys)
+        pipeline.hdel(SIZES_KEY, *keys)
+        pipeline.decrby(TOTAL_KEY, sum(int(s) for s in sizes if s))
+        pipeline.execute()
+
+    def evict(self):
+        # oldest blocks first, expired blocks are still counted until evicted
+        while int(self.redis.get(TOTAL_KEY) or 0) > self.budget:
+            oldest = self.redis.zrange(LRU_KEY, 0, 0)
+            if not oldest:
+                self.redis.delete(TOTAL_KEY)
+                return
+            self.drop([key.decode() for key in oldest])
+
+
+class CachedKlineStore(KlineStore):
+    # Range reads go through the cache, a miss reads the whole blocks from
+    # the store and caches the complete ones. Every write goes through here
+    # too, so the cached blocks it touches are dropped before the next read.
+
+    def __init__(
+        self, store: KlineStore, cache: KlineCache, coverage: KlineCoverageIndex
+    ):
+        self.store = store
+        self.cache = cache
+        self.coverage = coverage
+
+    def cached(self, series: KlineSeries, start: int, end: int) -> KlineArrays | None:
+        return self.cache.get(KlineRangePlanner(series.exchange), series, start, end)
+
+    def read(
+        self, series: KlineSeries, start: int = None, end: int = None
+    ) -> KlineArrays:
+        if start is None or end is None:
+            return self.store.read(series, start, end)
+        klines = self.cached(series, start, end)
+        if klines is not None:
+            return klines
+        planner = KlineRangePlanner(series.exchange)
+        blocks = self.cache.blocks(planner, series, start, end)
+        blocks_end = blocks[-1] + self.cache.block_seconds(planner, series.interval)
+        klines = self.store.read(series, blocks[0], blocks_end - 1)
+        covered = self.coverage.covered(series)
+        self.cache.put(planner, series, klines, covered, start, end)
+        return klines.take((klines.time >= start) & (klines.time <= end))
+
+    def iter_read(
+        self, series: KlineSeries, start: int = None, end: int = None, **kwargs
+    ):
+        return self.store.iter_read(series, start, end, **kwargs)
+
+    def oldest(self, series: KlineSeries) -> int | None:
+        return self.store.oldest(series)
+
+    def write(self, series: KlineSeries, klines: KlineArrays):
+        self.store.write(series, klines)
+        self.cache.invalidate(KlineRangePlanner(series.exchange), series, klines.time)
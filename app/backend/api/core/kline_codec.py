@@ -0,0 +1,137 @@
+import struct
+import zlib
+from typing import Iterable, Iterator
+
+import numpy as np
+
+from backend.api.core.kline_arrays import KLINE_COLUMNS, KlineArrays
+
+try:
+    import zstandard
+except ImportError:  # zlib is used when zstd is not installed
+    zstandard = None
+
+# A block is a header (magic, kline count, compressor) followed by the
+# compressed columns. Times are stored as deltas, all equal for a series
+# without gaps. Prices and volumes come from decimal strings, so a column
+# that is exactly integer / 10**scale is stored as deltas of those integers;
+# any other float column is XORed with its previous value, which zeroes the
+# bits that did not change. Columns are byte shuffled (all first bytes, all
+# second bytes...) so the zeros form long runs the compressor removes.
+MAGIC = b"KLC1"
+HEADER = struct.Struct("<4sIB")
+# per float column: encoding and decimal scale
+COLUMN_HEADER = struct.Struct("<BB")
+ZLIB, ZSTD = 0, 1
+XOR, DECIMAL = 0, 1
+MAX_SCALE = 12
+MEDIA_TYPE = "application/x-kline-codec"
+
+
+def shuffle(values: np.ndarray) -> bytes:
+    return values.astype("<u8").view(np.uint8).reshape(-1, 8).T.tobytes()
+
+
+def unshuffle(data: bytes, count: int) -> np.ndarray:
+    columns = np.frombuffer(data, dtype=np.uint8).reshape(8, count)
+    return columns.T.copy().view("<u8").ravel()
+
+
+def zigzag(values: np.ndarray) -> np.ndarray:
+    # small negative deltas become small positive integers
+    return ((values << 1) ^ (values >> 63)).view(np.uint64)
+
+
+def unzigzag(values: np.ndarray) -> np.ndarray:
+    return ((values >> np.uint64(1)).view(np.int64)) ^ -(values & np.uint64(1)).view(
+        np.int64
+    )
+
+
+def deltas(values: np.ndarray) -> np.ndarray:
+    return np.diff(values, prepend=np.int64(0))
+
+
+def decimal_scale(values: np.ndarray) -> int | None:
+    for scale in range(MAX_SCALE + 1):
+        integers = np.rint(values * 10**scale)
+        if np.abs(integers).max(initial=0) >= 2**53:
+            return None
+        if np.array_equal(integers / 10**scale, values):
+            return scale
+    return None
+
+
+def encode_column(values: np.ndarray) -> bytes:
+    scale = decimal_scale(values)
+    if scale is not None:
+        integers = np.rint(values * 10**scale).astype(np.int64)
+        return COLUMN_HEADER.pack(DECIMAL, scale) + shuffle(zigzag(deltas(integers)))
+    bits = values.astype("<f8").view("<u8")
+    previous = np.zeros_like(bits)
+    previous[1:] = bits[:-1]
+    return COLUMN_HEADER.pack(XOR, 0) + shuffle(bits ^ previous)
+
+
+def decode_column(data: bytes, count: int) -> np.ndarray:
+    encoding, scale = COLUMN_HEADER.unpack_from(data)
+    values = unshuffle(data[COLUMN_HEADER.size :], count)
+    if encoding == DECIMAL:
+        return np.cumsum(unzigzag(values)) / 10**scale
+    return np.bitwise_xor.accumulate(values).view("<f8")
+
+
+def compress(data: bytes) -> tuple:
+    if zstandard is not None:
+        return ZSTD, zstandard.ZstdCompressor(level=3).compress(data)
+    return ZLIB, zlib.compress(data, 3)
+
+
+def decompress(compressor: int, data: bytes) -> bytes:
+    if compressor == ZSTD:
+        if zstandard is None:
+            raise ValueError(
+                "kline block compressed with zstd, zstandard is not installed"
+            )
+        return zstandard.ZstdDecompressor().decompress(data)
+    return zlib.decompress(data)
+
+
+def encode_klines(klines: KlineArrays) -> bytes:
+    columns = [shuffle(zigzag(deltas(klines.time.astype(np.int64))))]
+    for c in KLINE_COLUMNS[1:]:
+        columns.append(encode_column(getattr(klines, c).astype(np.float64)))
+    compressor, payload = compress(b"".join(columns))
+    return HEADER.pack(MAGIC, len(klines), compressor) + payload
+
+
+def decode_klines(block: bytes) -> KlineArrays:
+    magic, count, compressor = HEADER.unpack_from(block)
+    if magic != MAGIC:
+        raise ValueError("not a kline block")
+    data = decompress(compressor, block[HEADER.size :])
+    size = count * 8
+    time = np.cumsum(unzigzag(unshuffle(data[:size], count)))
+    columns, offset = {}, size
+    for c in KLINE_COLUMNS[1:]:
+        end = offset + COLUMN_HEADER.size + size
+        columns[c] = decode_column(data[offset:end], count)
+        offset = end
+    return KlineArrays(time=time, **columns)
+
+
+def encode_stream(chunks: Iterable[KlineArrays]) -> Iterator[bytes]:
+    # blocks one after the other, each prefixed with its length
+    for klines in chunks:
+        if len(klines):
+            block = encode_klines(klines)
+            yield struct.pack("<I", len(block)) + block
+
+
+def decode_stream(data: bytes) -> KlineArrays:
+    parts, offset = [], 0
+    while offset < len(data):
+        (size,) = struct.unpack_from("<I", data, offset)
+        parts.append(decode_klines(data[offset + 4 : offset + 4 + size]))
+        offset += 4 + size
+    return KlineArrays.concat(parts, sort=False)
@@ -0,0 +1,139 @@
+import logging
+import os
+import time
+from typing import List, Tuple
+
+from sqlalchemy import delete, text
+from sqlalchemy.orm import Session
+
+from backend.api.core.exchanges_clients import ExchangeClient
+from backend.api.core.kline_store import KlineSeries, KlineStore
+from backend.api.models.crypto import KlineCoverage
+
+logger = logging.getLogger(__name__)
+
+# request windows of one range downloaded at the same time, the rate
+# limiter still bounds the requests of the whole exchange
+KLINE_DOWNLOAD_CONCURRENCY = int(os.environ.get("KLINE_DOWNLOAD_CONCURRENCY", 4))
+
+Range = Tuple[int, int]
+
+
+def merge_ranges(ranges: List[Range]) -> List[Range]:
+    # sorted, overlapping and touching ranges joined
+    merged = []
+    for start, end in sorted(ranges):
+        if merged and start <= merged[-1][1]:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], end))
+        else:
+            merged.append((start, end))
+    return merged
+
+
+def missing_ranges(covered: List[Range], start: int, end: int) -> List[Range]:
+    # parts of [start, end) outside the merged `covered` ranges
+    missing = []
+    for covered_start, covered_end in covered:
+        if covered_end <= start:
+            continue
+        if covered_start >= end:
+            break
+        if covered_start > start:
+            missing.append((start, covered_start))
+        start = max(start, covered_end)
+    if start < end:
+        missing.append((start, end))
+    return missing
+
+
+class KlineCoverageIndex:
+    # Which time ranges of a series are already stored. Ranges only grow
+    # when the exchange answered for the whole range, including ranges with
+    # no klines at all (before the listing), so they are not asked again.
+
+    def __init__(self, db: Session):
+        self.db = db
+
+    def query(self, series: KlineSeries):
+        return self.db.query(KlineCoverage).filter(
+            KlineCoverage.symbol_id == series.symbol_id,
+            KlineCoverage.interval_id == series.interval_id,
+        )
+
+    def covered(self, series: KlineSeries) -> List[Range]:
+        rows = self.query(series).order_by(KlineCoverage.start.asc()).all()
+        return [(row.start, row.end) for row in rows]
+
+    def missing(self, series: KlineSeries, start: int, end: int) -> List[Range]:
+        return missing_ranges(self.covered(series), start, end)
+
+    def add(self, series: KlineSeries, start: int, end: int):
+        if start >= end:
+            return
+        # backfill chunks and the follow task add ranges of a series at the
+        # same time, the stored ranges are read by deleting them so a second
+        # add waits on the row locks (the series lock when there are none)
+        # and never writes back a merge missing the first one's range
+        self.lock(series)
+        stored = self.db.execute(
+            delete(KlineCoverage)
+            .where(
+                KlineCoverage.symbol_id == series.symbol_id,
+                KlineCoverage.interval_id == series.interval_id,
+            )
+            .returning(KlineCoverage.start, KlineCoverage.end)
+        ).all()
+        ranges = merge_ranges([tuple(r) for r in stored] + [(start, end)])
+        self.db.add_all(
+            KlineCoverage(
+                symbol_id=series.symbol_id,
+                interval_id=series.interval_id,
+                start=range_start,
+                end=range_end,
+            )
+            for range_start, range_end in ranges
+        )
+        self.db.commit()
+
+    def lock(self, series: KlineSeries):
+        # held until the transaction ends, sqlite serializes writers itself
+        if self.db.get_bind().dialect.name == "postgresql":
+            self.db.execute(
+                text("SELECT pg_advisory_xact_lock(:symbol_id, :interval_id)"),
+                {"symbol_id": series.symbol_id, "interval_id": series.interval_id},
+            )
+
+
+def fetch_missing_klines(
+    client: ExchangeClient,
+    store: KlineStore,
+    coverage: KlineCoverageIndex,
+    series: KlineSeries,
+    start: int,
+    end: int,
+) -> int:
+    """download and store the klines of [start, end) that are not stored yet"""
+    now = int(time.time())
+    end = min(end, now)
+    # the candle still open is stored but not covered, the next request
+    # downloads it again with its final values
+    current_open = client.planner.align(now, series.interval)
+    exchange_symbol = client.build_symbol_pair(series.symbol, series.pair)
+    fetched = 0
+    for gap_start, gap_end in coverage.missing(series, start, end):
+        klines = client.get_symbol_kline_arrays(
+            exchange_symbol,
+            series.interval,
+            gap_start,
+            gap_end,
+            concurrency=KLINE_DOWNLOAD_CONCURRENCY,
+        )
+        # an error answer raised above, only real answers are covered
+        store.write(series, klines)
+        coverage.add(series, gap_start, min(gap_end, current_open))
+        fetched += len(klines)
+        logger.info(
+            f"{exchange_symbol} {series.interval} [{gap_start}, {gap_end}): "
+            f"{len(klines)} klines fetched"
+        )
+    return fetched
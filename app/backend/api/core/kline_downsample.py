@@ -0,0 +1,65 @@
+import numpy as np
+
+from backend.api.core.kline_arrays import KlineArrays
+
+# ohlc merges consecutive candles, lttb keeps the candles that shape the
+# close line the most
+DOWNSAMPLE_MODES = ("ohlc", "lttb")
+
+
+def ohlc_buckets(klines: KlineArrays, max_points: int) -> KlineArrays:
+    """at most max_points candles, each one merging the same number of
+    consecutive candles (first open, max high, min low, last close)"""
+    if len(klines) <= max_points:
+        return klines
+    size = -(-len(klines) // max_points)
+    starts = np.arange(0, len(klines), size)
+    ends = np.r_[starts[1:], len(klines)] - 1
+    return KlineArrays(
+        time=klines.time[starts],
+        open=klines.open[starts],
+        high=np.maximum.reduceat(klines.high, starts),
+        low=np.minimum.reduceat(klines.low, starts),
+        close=klines.close[ends],
+        volume=np.add.reduceat(klines.volume, starts),
+    )
+
+
+def lttb_indices(x: np.ndarray, y: np.ndarray, max_points: int) -> np.ndarray:
+    """indices of the points kept by largest triangle three buckets"""
+    n = len(x)
+    if max_points >= n:
+        return np.arange(n)
+    if max_points < 3:
+        # no room for a bucket between the ends, the last point goes first
+        return np.array([0, n - 1][-max_points:], dtype=np.int64)
+    x = x.astype(np.float64)
+    # the first and last points are kept, the others are split in buckets
+    edges = 1 + np.arange(max_points - 1) * (n - 2) // (max_points - 2)
+    counts = np.diff(edges)
+    # reduceat runs the last bucket to the end of the array, the last point
+    # is not part of it
+    average_x = np.add.reduceat(x[: edges[-1]], edges[:-1]) / counts
+    average_y = np.add.reduceat(y[: edges[-1]], edges[:-1]) / counts
+    # the third vertex of a bucket's triangles is the next bucket's average
+    next_x = np.r_[average_x[1:], x[-1]]
+    next_y = np.r_[average_y[1:], y[-1]]
+    selected = np.empty(max_points, dtype=np.int64)
+    selected[0], selected[-1] = 0, n - 1
+    a = 0
+    for i in range(max_points - 2):
+        start, end = edges[i], edges[i + 1]
+        # twice the triangle areas of every point of the bucket at once
+        areas = np.abs(
+            (x[a] - next_x[i]) * (y[start:end] - y[a])
+            - (x[a] - x[start:end]) * (next_y[i] - y[a])
+        )
+        a = start + int(np.argmax(areas))
+        selected[i + 1] = a
+    return selected
+
+
+def downsample_klines(klines: KlineArrays, max_points: int, mode: str) -> KlineArrays:
+    if mode == "lttb":
+        return klines.take(lttb_indices(klines.time, klines.close, max_points))
+    return ohlc_buckets(klines, max_points)
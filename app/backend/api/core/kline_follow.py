@@ -0,0 +1,169 @@
+import asyncio
+import logging
+import os
+import time
+from typing import List, Tuple
+
+from sqlalchemy.orm import Session
+
+from backend.api.core.exchanges_clients import (
+    AsyncExchangeClient,
+    AsyncKuCoinClient,
+    AsyncMexcClient,
+)
+from backend.api.core.kline_arrays import KlineArrays
+from backend.api.core.kline_coverage import KlineCoverageIndex
+from backend.api.core.kline_planner import KlineRangePlanner
+from backend.api.core.kline_store import KlineSeries, KlineStore
+from backend.api.models.crypto import (
+    Exchange,
+    Interval,
+    KlineWatermark,
+    Pair,
+    Symbol,
+)
+
+logger = logging.getLogger(__name__)
+
+# symbols of one exchange fetched at the same time
+KLINE_FOLLOW_CONCURRENCY = int(os.environ.get("KLINE_FOLLOW_CONCURRENCY", 8))
+# candles fetched the first time a series is followed without a watermark
+KLINE_FOLLOW_LOOKBACK = int(os.environ.get("KLINE_FOLLOW_LOOKBACK", 100))
+
+ASYNC_CLIENT_CLASSES = {
+    "KuCoin": AsyncKuCoinClient,
+    "MEXC": AsyncMexcClient,
+}
+
+
+def build_async_client(exchange: Exchange) -> AsyncExchangeClient:
+    return ASYNC_CLIENT_CLASSES[exchange.name](
+        id=exchange.id,
+        name=exchange.name,
+        api_key=exchange.api_key,
+        api_secret=exchange.secret_key,
+        passphrase=exchange.passphrase,
+        base_url=exchange.base_url,
+    )
+
+
+class KlineWatermarks:
+    # The followed series and the open time of their newest stored kline.
+
+    def __init__(self, db: Session):
+        self.db = db
+
+    def query(self, series: KlineSeries):
+        return self.db.query(KlineWatermark).filter(
+            KlineWatermark.symbol_id == series.symbol_id,
+            KlineWatermark.interval_id == series.interval_id,
+        )
+
+    def track(self, series: KlineSeries):
+        if not self.query(series).first():
+            self.db.add(
+                KlineWatermark(
+                    symbol_id=series.symbol_id, interval_id=series.interval_id
+                )
+            )
+            self.db.commit()
+
+    def untrack(self, series: KlineSeries):
+        self.query(series).delete(synchronize_session=False)
+        self.db.commit()
+
+    def tracked(self, exchange: str) -> List[Tuple[KlineSeries, int | None]]:
+        rows = (
+            self.db.query(KlineWatermark, Exchange.name, Symbol, Pair.name, Interval)
+            .join(Symbol, Symbol.id == KlineWatermark.symbol_id)
+            .join(Pair, Pair.id == Symbol.pair_id)
+            .join(Interval, Interval.id == KlineWatermark.interval_id)
+            .join(Exchange, Exchange.id == Symbol.exchange_id)
+            .filter(Exchange.name == exchange)
+            .all()
+        )
+        return [
+            (
+                KlineSeries(
+                    exchange=exchange_name,
+                    symbol=symbol.name,
+                    pair=pair,
+                    interval=interval.name,
+                    symbol_id=symbol.id,
+                    interval_id=interval.id,
+                ),
+                watermark.time,
+            )
+            for watermark, exchange_name, symbol, pair, interval in rows
+        ]
+
+    def advance(self, series: KlineSeries, watermark: int):
+        self.query(series).update(
+            {KlineWatermark.time: watermark}, synchronize_session=False
+        )
+
+
+async def fetch_since_watermarks(
+    exchange: Exchange,
+    tracked: List[Tuple[KlineSeries, int | None]],
+    now: int,
+) -> List[KlineArrays | BaseException]:
+    # one request per series from its watermark, all the series at once. The
+    # client lives for one run, its connections belong to this event loop
+    client = build_async_client(exchange)
+    semaphore = asyncio.Semaphore(KLINE_FOLLOW_CONCURRENCY)
+
+    async def fetch(series: KlineSeries, watermark: int | None):
+        current_open = client.planner.align(now, series.interval)
+        if watermark is None:
+            watermark = client.planner.next_open(
+                current_open, series.interval, -KLINE_FOLLOW_LOOKBACK
+            )
+        async with semaphore:
+            return await client.get_symbol_kline_arrays(
+                client.build_symbol_pair(series.symbol, series.pair),
+                series.interval,
+                watermark,
+                client.planner.next_open(current_open, series.interval),
+            )
+
+    try:
+        return await asyncio.gather(
+            *[fetch(series, watermark) for series, watermark in tracked],
+            return_exceptions=True,
+        )
+    finally:
+        await client.aclose()
+
+
+def follow_klines(
+    exchange: Exchange,
+    store: KlineStore,
+    coverage: KlineCoverageIndex,
+    watermarks: KlineWatermarks,
+) -> int:
+    """store the klines of every followed series of `exchange` opened since
+    its watermark, the watermark candle included as it may have been stored
+    while still open"""
+    tracked = watermarks.tracked(exchange.name)
+    if not tracked:
+        return 0
+    now = int(time.time())
+    planner = KlineRangePlanner(exchange.name)
+    results = asyncio.run(fetch_since_watermarks(exchange, tracked, now))
+    fetched = 0
+    for (series, watermark), klines in zip(tracked, results):
+        if isinstance(klines, BaseException):
+            logger.error(f"{series.symbol}-{series.pair} {series.interval}: {klines}")
+            continue
+        if not len(klines):
+            continue
+        store.write(series, klines)
+        # the open candle is stored but not covered
+        current_open = planner.align(now, series.interval)
+        coverage.add(series, watermark or int(klines.time[0]), current_open)
+        watermarks.advance(series, int(klines.time[-1]))
+        fetched += len(klines)
+    watermarks.db.commit()
+    logger.info(f"{exchange.name}: {fetched} klines for {len(tracked)} followed series")
+    return fetched
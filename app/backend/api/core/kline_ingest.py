@@ -0,0 +1,112 @@
+import csv
+import io
+import logging
+import os
+import time
+
+from sqlalchemy import column, insert, or_, select, table
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.orm import Session
+
+from backend.api.core.kline_arrays import KLINE_COLUMNS, KlineArrays
+from backend.api.models.crypto import Kline
+
+logger = logging.getLogger(__name__)
+
+KLINE_INGEST_BATCH_SIZE = int(os.environ.get("KLINE_INGEST_BATCH_SIZE", 5000))
+KLINE_KEY = ["symbol_id", "interval_id", "time"]
+INGEST_COLUMNS = ["symbol_id", "interval_id"] + KLINE_COLUMNS
+UPSERT_DIALECTS = {"postgresql": postgresql.insert, "sqlite": sqlite.insert}
+
+
+def kline_upsert(dialect: str):
+    # insert new candles, a candle already stored (the last one, still open
+    # when it was written) is updated only if its values changed, so
+    # writing the same klines again does not rewrite any row
+    klines = Kline.__table__
+    if dialect not in UPSERT_DIALECTS:
+        return insert(klines)
+    stmt = UPSERT_DIALECTS[dialect](klines)
+    values = KLINE_COLUMNS[1:]
+    return stmt.on_conflict_do_update(
+        index_elements=KLINE_KEY,
+        set_={c: stmt.excluded[c] for c in values},
+        where=or_(*[klines.c[c] != stmt.excluded[c] for c in values]),
+    )
+
+
+class KlineIngestor:
+    # Streams klines of one symbol and interval into the klines table. Rows
+    # go in fixed-size batches and every batch is committed, so memory does
+    # not grow with the backfill and a failure keeps what was written.
+    # PostgreSQL gets the rows through COPY into a staging table that is
+    # upserted into klines, other databases through one executemany upsert
+    # per batch.
+
+    def __init__(
+        self,
+        db: Session,
+        symbol_id: int,
+        interval_id: int,
+        batch_size: int = KLINE_INGEST_BATCH_SIZE,
+    ):
+        self.db = db
+        self.symbol_id = symbol_id
+        self.interval_id = interval_id
+        self.batch_size = batch_size
+        self.dialect = db.get_bind().dialect.name
+        self.use_copy = self.dialect == "postgresql"
+        self.rows = 0
+        self.batches = 0
+        self.seconds = 0.0
+
+    @property
+    def rows_per_second(self) -> float:
+        return self.rows / self.seconds if self.seconds else 0.0
+
+    def write(self, klines: KlineArrays):
+        for start in range(0, len(klines), self.batch_size):
+            batch = klines.take(slice(start, start + self.batch_size))
+            started = time.perf_counter()
+            if self.use_copy:
+                self.copy(batch)
+            else:
+                self.insert(batch)
+            self.db.commit()
+            self.seconds += time.perf_counter() - started
+            self.rows += len(batch)
+            self.batches += 1
+
+    def insert(self, batch: KlineArrays):
+        self.db.execute(
+            kline_upsert(self.dialect), batch.to_rows(self.symbol_id, self.interval_id)
+        )
+
+    def copy(self, batch: KlineArrays):
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+        values = [getattr(batch, c).tolist() for c in KLINE_COLUMNS]
+        for row in zip(*values):
+            writer.writerow((self.symbol_id, self.interval_id, *row))
+        buffer.seek(0)
+        columns = ", ".join(INGEST_COLUMNS)
+        # raw psycopg2 cursor on the connection of the session transaction,
+        # the staging table is dropped by the batch commit
+        cursor = self.db.connection().connection.cursor()
+        cursor.execute(
+            f"CREATE TEMP TABLE klines_ingest ON COMMIT DROP AS "
+            f"SELECT {columns} FROM {Kline.__tablename__} WITH NO DATA"
+        )
+        cursor.copy_expert(
+            f"COPY klines_ingest ({columns}) FROM STDIN WITH (FORMAT csv)", buffer
+        )
+        staged = select(*[column(c) for c in INGEST_COLUMNS]).select_from(
+            table("klines_ingest")
+        )
+        self.db.execute(kline_upsert(self.dialect).from_select(INGEST_COLUMNS, staged))
+
+    def log(self, name: str):
+        logger.info(
+            f"{name}: {self.rows} klines in {self.batches} batches, "
+            f"{self.rows_per_second:.0f} rows/s"
+        )
@@ -0,0 +1,180 @@
+import argparse
+import logging
+import os
+from datetime import datetime, timezone
+from typing import List
+
+from sqlalchemy import text
+from sqlalchemy.engine import Connection, Engine
+
+from backend.api.core.kline_planner import month_open
+
+logger = logging.getLogger(__name__)
+
+# On PostgreSQL the klines table is partitioned by month of `time`. The ORM
+# model is unchanged, only the physical table is: the primary key becomes
+# (id, time) as partitioned tables require, rows outside every monthly
+# partition land in klines_default. The table is only converted when asked
+# to, `python -m backend.api.core.kline_partitions partition` rewrites every
+# stored kline under an exclusive lock.
+# first monthly partition, older klines go to the default partition
+KLINE_PARTITIONS_FROM = os.environ.get("KLINE_PARTITIONS_FROM", "2017-01")
+KLINE_PARTITIONS_AHEAD = int(os.environ.get("KLINE_PARTITIONS_AHEAD", 2))
+# months of klines kept, unset keeps everything
+KLINE_RETENTION_MONTHS = os.environ.get("KLINE_RETENTION_MONTHS")
+
+
+def partition_name(month: int) -> str:
+    date = datetime.fromtimestamp(month, tz=timezone.utc)
+    return f"klines_y{date.year}m{date.month:02d}"
+
+
+def month_range(first: int, last: int) -> List[int]:
+    months = [first]
+    while months[-1] < last:
+        months.append(month_open(months[-1], 1))
+    return months
+
+
+def is_partitioned(connection: Connection) -> bool:
+    return (
+        connection.execute(
+            text("SELECT relkind FROM pg_class WHERE relname = 'klines'")
+        ).scalar()
+        == "p"
+    )
+
+
+def existing_partitions(connection: Connection) -> List[str]:
+    return (
+        connection.execute(
+            text(
+                "SELECT child.relname FROM pg_inherits "
+                "JOIN pg_class parent ON parent.oid = pg_inherits.inhparent "
+                "JOIN pg_class child ON child.oid = pg_inherits.inhrelid "
+                "WHERE parent.relname = 'klines'"
+            )
+        )
+        .scalars()
+        .all()
+    )
+
+
+def create_partitions(connection: Connection, months: List[int]):
+    existing = set(existing_partitions(connection))
+    for month in months:
+        name = partition_name(month)
+        if name in existing:
+            continue
+        connection.execute(
+            text(
+                f"CREATE TABLE {name} PARTITION OF klines "
+                f"FOR VALUES FROM ({month}) TO ({month_open(month, 1)})"
+            )
+        )
+        logger.info(f"created partition {name}")
+
+
+def partition_klines(engine: Engine):
+    """turn an unpartitioned klines table into a monthly partitioned one"""
+    if engine.dialect.name != "postgresql":
+        return
+    with engine.begin() as connection:
+        if is_partitioned(connection):
+            return
+        logger.info("partitioning klines by month")
+        connection.execute(text("ALTER TABLE klines RENAME TO klines_unpartitioned"))
+        connection.execute(
+            text(
+                "ALTER TABLE klines_unpartitioned "
+                "RENAME CONSTRAINT klines_pkey TO klines_unpartitioned_pkey"
+            )
+        )
+        connection.execute(
+            text(
+                "ALTER INDEX IF EXISTS ix_klines_symbol_interval_time "
+                "RENAME TO ix_klines_unpartitioned_symbol_interval_time"
+            )
+        )
+        connection.execute(
+            text(
+                "CREATE TABLE klines (LIKE klines_unpartitioned INCLUDING DEFAULTS) "
+                "PARTITION BY RANGE (time)"
+            )
+        )
+        connection.execute(text("ALTER TABLE klines ADD PRIMARY KEY (id, time)"))
+        connection.execute(
+            text(
+                "CREATE UNIQUE INDEX ix_klines_symbol_interval_time "
+                "ON klines (symbol_id, interval_id, time)"
+            )
+        )
+        # the id sequence must survive the old table
+        connection.execute(text("ALTER SEQUENCE klines_id_seq OWNED BY klines.id"))
+        connection.execute(
+            text("CREATE TABLE klines_default PARTITION OF klines DEFAULT")
+        )
+        first = datetime.strptime(KLINE_PARTITIONS_FROM, "%Y-%m")
+        first = int(first.replace(tzinfo=timezone.utc).timestamp())
+        now = int(datetime.now(tz=timezone.utc).timestamp())
+        create_partitions(
+            connection, month_range(first, month_open(now, KLINE_PARTITIONS_AHEAD))
+        )
+        moved = connection.execute(
+            text("INSERT INTO klines SELECT * FROM klines_unpartitioned")
+        ).rowcount
+        connection.execute(text("DROP TABLE klines_unpartitioned"))
+        logger.info(f"klines partitioned, {moved} rows moved")
+
+
+def maintain_partitions(engine: Engine):
+    """create the coming monthly partitions and drop expired ones"""
+    if engine.dialect.name != "postgresql":
+        return
+    now = int(datetime.now(tz=timezone.utc).timestamp())
+    with engine.begin() as connection:
+        if not is_partitioned(connection):
+            return
+        create_partitions(
+            connection,
+            month_range(month_open(now), month_open(now, KLINE_PARTITIONS_AHEAD)),
+        )
+    if KLINE_RETENTION_MONTHS:
+        drop_partitions_before(engine, month_open(now, -int(KLINE_RETENTION_MONTHS)))
+
+
+def drop_partitions_before(engine: Engine, cutoff: int):
+    # whole months are dropped, the coverage of the dropped range goes too
+    # so it is downloaded again if it is ever requested
+    keep = partition_name(cutoff)
+    with engine.begin() as connection:
+        for name in existing_partitions(connection):
+            if name.startswith("klines_y") and name < keep:
+                connection.execute(text(f"DROP TABLE {name}"))
+                logger.info(f"dropped partition {name}")
+        connection.execute(
+            text('DELETE FROM kline_coverage WHERE "end" <= :cutoff'),
+            {"cutoff": cutoff},
+        )
+        connection.execute(
+            text("UPDATE kline_coverage SET start = :cutoff WHERE start < :cutoff"),
+            {"cutoff": cutoff},
+        )
+        connection.execute(
+            text("DELETE FROM klines_default WHERE time < :cutoff"),
+            {"cutoff": cutoff},
+        )
+
+
+if __name__ == "__main__":
+    from backend.api.database import engine
+
+    parser = argparse.ArgumentParser(description="klines table partitions")
+    parser.add_argument("command", choices=["partition", "maintain"])
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+
+    if args.command == "partition":
+        partition_klines(engine)
+    else:
+        maintain_partitions(engine)
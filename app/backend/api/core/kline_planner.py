@@ -0,0 +1,125 @@
+from datetime import datetime, timezone
+from typing import Dict, List, Tuple
+
+MONTH = "month"
+# weekly candles open on monday 00:00 UTC, the unix epoch was a thursday
+WEEK_OFFSET = 4 * 24 * 60 * 60
+
+# exchange interval name -> candle duration in seconds
+EXCHANGE_INTERVALS: Dict[str, Dict[str, int | str]] = {
+    "KuCoin": {
+        "1min": 60,
+        "3min": 3 * 60,
+        "5min": 5 * 60,
+        "15min": 15 * 60,
+        "30min": 30 * 60,
+        "1hour": 60 * 60,
+        "2hour": 2 * 60 * 60,
+        "4hour": 4 * 60 * 60,
+        "6hour": 6 * 60 * 60,
+        "8hour": 8 * 60 * 60,
+        "12hour": 12 * 60 * 60,
+        "1day": 24 * 60 * 60,
+        "1week": 7 * 24 * 60 * 60,
+        "1month": MONTH,
+    },
+    "MEXC": {
+        "1m": 60,
+        "5m": 5 * 60,
+        "15m": 15 * 60,
+        "30m": 30 * 60,
+        "60m": 60 * 60,
+        "4h": 4 * 60 * 60,
+        "8h": 8 * 60 * 60,
+        "1d": 24 * 60 * 60,
+        "1W": 7 * 24 * 60 * 60,
+        "1M": MONTH,
+    },
+}
+
+# maximum number of klines returned by one request
+REQUEST_LIMITS: Dict[str, int] = {
+    "KuCoin": 1500,
+    "MEXC": 1000,
+}
+
+
+def month_open(time: int, months: int = 0) -> int:
+    # open of the month containing `time`, moved by `months`
+    date = datetime.fromtimestamp(time, tz=timezone.utc)
+    month = date.year * 12 + date.month - 1 + months
+    open_date = datetime(month // 12, month % 12 + 1, 1, tzinfo=timezone.utc)
+    return int(open_date.timestamp())
+
+
+class KlineRangePlanner:
+    # Splits a [start, end) range into the fewest request windows. Windows
+    # start on candle opens, hold at most the exchange limit of klines and do
+    # not overlap, so every kline in the range is requested exactly once.
+
+    def __init__(self, exchange: str):
+        self.exchange = exchange
+        self.intervals = EXCHANGE_INTERVALS[exchange]
+        self.limit = REQUEST_LIMITS[exchange]
+
+    def interval_seconds(self, interval: str) -> int | str:
+        if interval not in self.intervals:
+            raise ValueError(f"{self.exchange} has no {interval} interval")
+        return self.intervals[interval]
+
+    def offset(self, interval: str) -> int:
+        return WEEK_OFFSET if self.interval_seconds(interval) == 7 * 86400 else 0
+
+    def align(self, time: int, interval: str) -> int:
+        """open time of the candle containing `time`"""
+        seconds = self.interval_seconds(interval)
+        if seconds == MONTH:
+            return month_open(time)
+        offset = self.offset(interval)
+        return (time - offset) // seconds * seconds + offset
+
+    def first_open(self, start: int, interval: str) -> int:
+        """first candle open at or after `start`"""
+        aligned = self.align(start, interval)
+        if aligned == start:
+            return aligned
+        return self.next_open(aligned, interval)
+
+    def next_open(self, time: int, interval: str, candles: int = 1) -> int:
+        seconds = self.interval_seconds(interval)
+        if seconds == MONTH:
+            return month_open(time, candles)
+        return time + seconds * candles
+
+    def count(self, interval: str, start: int, end: int) -> int:
+        """number of candles opening in [start, end)"""
+        return sum(
+            self.window_count(interval, window_start, window_end)
+            for window_start, window_end in self.plan(interval, start, end)
+        )
+
+    def window_count(self, interval: str, start: int, end: int) -> int:
+        seconds = self.interval_seconds(interval)
+        if seconds != MONTH:
+            return -(-(end - start) // seconds)
+        count, time = 0, start
+        while time < end:
+            count, time = count + 1, month_open(time, 1)
+        return count
+
+    def window_seconds(self, interval: str) -> int:
+        """span of one full request window, months counted as 31 days"""
+        seconds = self.interval_seconds(interval)
+        if seconds == MONTH:
+            seconds = 31 * 24 * 60 * 60
+        return seconds * self.limit
+
+    def plan(self, interval: str, start: int, end: int) -> List[Tuple[int, int]]:
+        """request windows [window_start, window_end) covering [start, end)"""
+        windows = []
+        window_start = self.first_open(start, interval)
+        while window_start < end:
+            window_end = min(self.next_open(window_start, interval, self.limit), end)
+            windows.append((window_start, window_end))
+            window_start = window_end
+        return windows
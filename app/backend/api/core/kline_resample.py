@@ -0,0 +1,118 @@
+import logging
+import os
+from dataclasses import replace
+from typing import Dict
+
+import numpy as np
+
+from backend.api.core.kline_arrays import KlineArrays
+from backend.api.core.kline_coverage import KlineCoverageIndex
+from backend.api.core.kline_planner import MONTH, KlineRangePlanner
+from backend.api.core.kline_store import KlineSeries, KlineStore
+
+logger = logging.getLogger(__name__)
+
+# store resampled klines so the next request reads them directly
+KLINE_RESAMPLE_MATERIALIZE = (
+    os.environ.get("KLINE_RESAMPLE_MATERIALIZE", "false").lower() == "true"
+)
+
+DAY = 24 * 60 * 60
+
+
+class KlineResampler:
+    # Builds coarser candles from finer ones with the same boundaries the
+    # exchange uses (planner alignment): first open, max high, min low,
+    # last close and summed volume of the candles opening in each bucket.
+
+    def __init__(self, planner: KlineRangePlanner):
+        self.planner = planner
+
+    def can_resample(self, base: str, target: str) -> bool:
+        base_seconds = self.planner.interval_seconds(base)
+        target_seconds = self.planner.interval_seconds(target)
+        if base_seconds == MONTH or base == target:
+            return False
+        if target_seconds == MONTH:
+            # months start on a day boundary
+            return DAY % base_seconds == 0
+        return (
+            target_seconds % base_seconds == 0
+            and self.planner.offset(target) % base_seconds == 0
+        )
+
+    def bucket_opens(self, time: np.ndarray, target: str) -> np.ndarray:
+        seconds = self.planner.interval_seconds(target)
+        if seconds == MONTH:
+            months = time.astype("datetime64[s]").astype("datetime64[M]")
+            return months.astype("datetime64[s]").astype(np.int64)
+        offset = self.planner.offset(target)
+        return (time - offset) // seconds * seconds + offset
+
+    def resample(self, klines: KlineArrays, target: str) -> KlineArrays:
+        """`klines` ascending by time, one candle per bucket of `target`"""
+        if not len(klines):
+            return KlineArrays.empty()
+        opens = self.bucket_opens(klines.time, target)
+        starts = np.flatnonzero(np.r_[True, opens[1:] != opens[:-1]])
+        ends = np.r_[starts[1:], len(opens)] - 1
+        return KlineArrays(
+            time=opens[starts],
+            open=klines.open[starts],
+            high=np.maximum.reduceat(klines.high, starts),
+            low=np.minimum.reduceat(klines.low, starts),
+            close=klines.close[ends],
+            volume=np.add.reduceat(klines.volume, starts),
+        )
+
+
+def resample_stored_klines(
+    store: KlineStore,
+    coverage: KlineCoverageIndex,
+    planner: KlineRangePlanner,
+    series: KlineSeries,
+    interval_ids: Dict[str, int],
+    start: int,
+    end: int,
+    now: int,
+) -> KlineArrays | None:
+    """klines of `series` in [start, end) built from the coarsest stored
+    interval covering the whole range, None if the interval itself is stored
+    for the range or no other interval covers it"""
+    resampler = KlineResampler(planner)
+    first_open = planner.align(start, series.interval)
+    last_close = planner.next_open(
+        planner.align(end - 1, series.interval), series.interval
+    )
+    own_end = min(last_close, planner.align(now, series.interval))
+    if own_end > first_open and not coverage.missing(series, first_open, own_end):
+        # reading the stored candles beats aggregating finer ones
+        return None
+    # the coarsest base has the fewest candles to read and aggregate
+    bases = sorted(
+        (name for name in interval_ids if name in planner.intervals),
+        key=lambda name: planner.window_seconds(name),
+        reverse=True,
+    )
+    for base in bases:
+        if not resampler.can_resample(base, series.interval):
+            continue
+        base_series = replace(series, interval=base, interval_id=interval_ids[base])
+        # the open base candle is stored but never covered
+        covered_end = min(last_close, planner.align(now, base))
+        if covered_end <= first_open or coverage.missing(
+            base_series, first_open, covered_end
+        ):
+            continue
+        klines = resampler.resample(
+            store.read(base_series, first_open, last_close - 1), series.interval
+        )
+        logger.info(
+            f"{series.symbol}-{series.pair} {series.interval} resampled from {base}"
+        )
+        if KLINE_RESAMPLE_MATERIALIZE:
+            store.write(series, klines)
+            coverage.add(series, first_open, own_end)
+        keep = (klines.time >= start) & (klines.time < end)
+        return klines.take(keep)
+    return None
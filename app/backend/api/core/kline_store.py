@@ -0,0 +1,344 @@
+import fcntl
+import os
+from contextlib import contextmanager
+from dataclasses import dataclass
+from typing import Dict, Iterator
+
+import numpy as np
+from sqlalchemy import select
+from sqlalchemy.orm import Session
+
+from backend.api.core.kline_arrays import KLINE_COLUMNS, KlineArrays
+from backend.api.core.kline_codec import decode_klines, encode_klines
+from backend.api.core.kline_ingest import KlineIngestor
+from backend.api.models.crypto import Kline
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:  # the columnar stores are optional
+    pa = pq = None
+
+# sql keeps klines in the klines table, parquet, arrow and codec in files under
+# KLINE_STORE_PATH, one file per exchange/symbol/interval/month
+KLINE_STORE = os.environ.get("KLINE_STORE", "sql")
+KLINE_STORE_PATH = os.environ.get("KLINE_STORE_PATH", ".data/klines")
+# klines per chunk when a range is read in chunks
+KLINE_CHUNK_SIZE = int(os.environ.get("KLINE_CHUNK_SIZE", 10_000))
+
+
+@dataclass(frozen=True)
+class KlineSeries:
+    # what identifies the klines of one symbol and interval, the sql store
+    # uses the ids and the file stores the names
+    exchange: str
+    symbol: str
+    pair: str
+    interval: str
+    symbol_id: int
+    interval_id: int
+
+
+class KlineStore:
+    def read(
+        self, series: KlineSeries, start: int = None, end: int = None
+    ) -> KlineArrays:
+        """klines with start <= time <= end, ascending"""
+        raise NotImplementedError
+
+    def iter_read(
+        self,
+        series: KlineSeries,
+        start: int = None,
+        end: int = None,
+        chunk_size: int = KLINE_CHUNK_SIZE,
+    ) -> Iterator[KlineArrays]:
+        """same klines as read, in ascending chunks of at most chunk_size"""
+        yield from split_klines(self.read(series, start, end), chunk_size)
+
+    def cached(self, series: KlineSeries, start: int, end: int) -> KlineArrays | None:
+        """klines with start <= time <= end if they can be read without the store"""
+        return None
+
+    def write(self, series: KlineSeries, klines: KlineArrays):
+        raise NotImplementedError
+
+    def oldest(self, series: KlineSeries) -> int | None:
+        """open time of the oldest stored kline"""
+        raise NotImplementedError
+
+
+class SqlKlineStore(KlineStore):
+    def __init__(self, db: Session):
+        self.db = db
+
+    def range_query(self, series: KlineSeries, start: int = None, end: int = None):
+        # plain column tuples, no ORM object per kline
+        query = select(*[getattr(Kline, c) for c in KLINE_COLUMNS]).where(
+            Kline.symbol_id == series.symbol_id,
+            Kline.interval_id == series.interval_id,
+        )
+        if start is not None:
+            query = query.where(Kline.time >= int(start))
+        if end is not None:
+            query = query.where(Kline.time <= int(end))
+        return query.order_by(Kline.time.asc())
+
+    def read(
+        self, series: KlineSeries, start: int = None, end: int = None
+    ) -> KlineArrays:
+        return rows_to_klines(
+            self.db.execute(self.range_query(series, start, end)).all()
+        )
+
+    def iter_read(
+        self,
+        series: KlineSeries,
+        start: int = None,
+        end: int = None,
+        chunk_size: int = KLINE_CHUNK_SIZE,
+    ) -> Iterator[KlineArrays]:
+        # server side cursor, only one chunk of rows is held at a time. It
+        # gets its own session: a streamed response is read after the
+        # handler returned, a commit on the shared session would end it
+        db = Session(bind=self.db.get_bind())
+        try:
+            result = db.execute(
+                self.range_query(series, start, end),
+                execution_options={"stream_results": True, "yield_per": chunk_size},
+            )
+            for rows in result.partitions():
+                yield rows_to_klines(rows)
+        finally:
+            db.close()
+
+    def write(self, series: KlineSeries, klines: KlineArrays):
+        KlineIngestor(self.db, series.symbol_id, series.interval_id).write(klines)
+
+    def oldest(self, series: KlineSeries) -> int | None:
+        return self.db.execute(
+            select(Kline.time)
+            .where(
+                Kline.symbol_id == series.symbol_id,
+                Kline.interval_id == series.interval_id,
+            )
+            .order_by(Kline.time.asc())
+            .limit(1)
+        ).scalar()
+
+
+def rows_to_klines(rows) -> KlineArrays:
+    if not rows:
+        return KlineArrays.empty()
+    columns = list(zip(*rows))
+    return KlineArrays(
+        time=np.array(columns[0], dtype=np.int64),
+        **{
+            c: np.array(v, dtype=np.float64)
+            for c, v in zip(KLINE_COLUMNS[1:], columns[1:])
+        },
+    )
+
+
+def split_klines(klines: KlineArrays, chunk_size: int) -> Iterator[KlineArrays]:
+    for start in range(0, len(klines), chunk_size):
+        yield klines.take(slice(start, start + chunk_size))
+
+
+@contextmanager
+def file_lock(path: str):
+    # exclusive lock between processes on path + ".lock", readers do not lock
+    with open(path + ".lock", "w") as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock, fcntl.LOCK_UN)
+
+
+def month_of(time: np.ndarray) -> np.ndarray:
+    return time.astype("datetime64[s]").astype("datetime64[M]")
+
+
+class FileKlineStore(KlineStore):
+    # Columnar files partitioned as exchange/symbol-pair/interval/YYYY-MM.
+    # A write merges the new klines into the month files they fall in, new
+    # values win over stored ones; a read only opens the months overlapping
+    # the requested range.
+
+    extension = None
+    needs_pyarrow = True
+
+    def __init__(self, root: str = KLINE_STORE_PATH):
+        if self.needs_pyarrow and pa is None:
+            raise RuntimeError(f"KLINE_STORE={KLINE_STORE} needs pyarrow installed")
+        self.root = root
+
+    def series_path(self, series: KlineSeries) -> str:
+        return os.path.join(
+            self.root,
+            series.exchange,
+            f"{series.symbol}-{series.pair}",
+            series.interval,
+        )
+
+    def month_files(self, series: KlineSeries) -> Dict[np.datetime64, str]:
+        path = self.series_path(series)
+        if not os.path.isdir(path):
+            return {}
+        return {
+            np.datetime64(name[: -len(self.extension)], "M"): os.path.join(path, name)
+            for name in sorted(os.listdir(path))
+            if name.endswith(self.extension)
+        }
+
+    def read_months(
+        self, series: KlineSeries, start: int = None, end: int = None
+    ) -> Iterator[KlineArrays]:
+        files = self.month_files(series)
+        first = month_of(np.array([start])) if start is not None else None
+        last = month_of(np.array([end])) if end is not None else None
+        for month, path in files.items():
+            if (first is None or month >= first[0]) and (
+                last is None or month <= last[0]
+            ):
+                yield self.read_file(path, start, end)
+
+    def read(
+        self, series: KlineSeries, start: int = None, end: int = None
+    ) -> KlineArrays:
+        # months are read in order and do not overlap
+        return KlineArrays.concat(
+            list(self.read_months(series, start, end)), sort=False
+        )
+
+    def iter_read(
+        self,
+        series: KlineSeries,
+        start: int = None,
+        end: int = None,
+        chunk_size: int = KLINE_CHUNK_SIZE,
+    ) -> Iterator[KlineArrays]:
+        for klines in self.read_months(series, start, end):
+            yield from split_klines(klines, chunk_size)
+
+    def write(self, series: KlineSeries, klines: KlineArrays):
+        if not len(klines):
+            return
+        path = self.series_path(series)
+        os.makedirs(path, exist_ok=True)
+        months = month_of(klines.time)
+        for month in np.unique(months):
+            file = os.path.join(path, f"{month}{self.extension}")
+            part = klines.take(months == month)
+            # concurrent writers of a month (backfill chunks, the follow
+            # task) merge one after the other instead of overwriting
+            with file_lock(file):
+                if os.path.exists(file):
+                    part = KlineArrays.concat([part, self.read_file(file)])
+                # readers never see a half written file
+                self.write_file(file + ".tmp", part)
+                os.replace(file + ".tmp", file)
+
+    def oldest(self, series: KlineSeries) -> int | None:
+        files = self.month_files(series)
+        if not files:
+            return None
+        klines = self.read_file(files[min(files)])
+        return int(klines.time[0]) if len(klines) else None
+
+    def read_file(self, path: str, start: int = None, end: int = None) -> KlineArrays:
+        raise NotImplementedError
+
+    def write_file(self, path: str, klines: KlineArrays):
+        raise NotImplementedError
+
+
+def table_to_arrays(table) -> KlineArrays:
+    return KlineArrays(**{c: table.column(c).to_numpy() for c in KLINE_COLUMNS})
+
+
+def arrays_to_table(klines: KlineArrays):
+    return pa.table({c: getattr(klines, c) for c in KLINE_COLUMNS})
+
+
+class ParquetKlineStore(FileKlineStore):
+    # compressed, the time filter is pushed down to the row group statistics
+    extension = ".parquet"
+
+    def read_file(self, path: str, start: int = None, end: int = None) -> KlineArrays:
+        filters = []
+        if start is not None:
+            filters.append(("time", ">=", start))
+        if end is not None:
+            filters.append(("time", "<=", end))
+        table = pq.read_table(
+            path, columns=KLINE_COLUMNS, filters=filters or None, memory_map=True
+        )
+        return table_to_arrays(table)
+
+    def write_file(self, path: str, klines: KlineArrays):
+        pq.write_table(arrays_to_table(klines), path, row_group_size=50_000)
+
+
+class ArrowKlineStore(FileKlineStore):
+    # uncompressed Arrow IPC, the columns are used straight from the memory
+    # map and the time range is cut with a binary search on the sorted times
+    extension = ".arrow"
+
+    def read_file(self, path: str, start: int = None, end: int = None) -> KlineArrays:
+        # the map stays open as long as the arrays taken from it are alive
+        table = pa.ipc.open_file(pa.memory_map(path)).read_all()
+        klines = table_to_arrays(table)
+        first = 0 if start is None else np.searchsorted(klines.time, start, "left")
+        last = (
+            len(klines) if end is None else np.searchsorted(klines.time, end, "right")
+        )
+        return klines.take(slice(first, last))
+
+    def write_file(self, path: str, klines: KlineArrays):
+        table = arrays_to_table(klines)
+        with pa.OSFile(path, "wb") as sink:
+            with pa.ipc.new_file(sink, table.schema) as writer:
+                writer.write_table(table)
+
+
+class CodecKlineStore(FileKlineStore):
+    # delta encoded and compressed blocks of kline_codec, the smallest files
+    # and no pyarrow needed
+    extension = ".klc"
+    needs_pyarrow = False
+
+    def read_file(self, path: str, start: int = None, end: int = None) -> KlineArrays:
+        with open(path, "rb") as f:
+            klines = decode_klines(f.read())
+        first = 0 if start is None else np.searchsorted(klines.time, start, "left")
+        last = (
+            len(klines) if end is None else np.searchsorted(klines.time, end, "right")
+        )
+        return klines.take(slice(first, last))
+
+    def write_file(self, path: str, klines: KlineArrays):
+        with open(path, "wb") as f:
+            f.write(encode_klines(klines))
+
+
+FILE_STORES = {
+    "parquet": ParquetKlineStore,
+    "arrow": ArrowKlineStore,
+    "codec": CodecKlineStore,
+}
+
+
+def get_kline_store(db: Session) -> KlineStore:
+    if KLINE_STORE in FILE_STORES:
+        store = FILE_STORES[KLINE_STORE]()
+    else:
+        store = SqlKlineStore(db)
+    # imported here, the cache and coverage modules build on this one
+    from backend.api.core.kline_cache import KLINE_CACHE, CachedKlineStore, KlineCache
+    from backend.api.core.kline_coverage import KlineCoverageIndex
+
+    if KLINE_CACHE:
+        return CachedKlineStore(store, KlineCache(), KlineCoverageIndex(db))
+    return store
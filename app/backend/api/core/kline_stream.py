@@ -0,0 +1,55 @@
+import io
+from typing import Iterable, Iterator
+
+from backend.api.core import kline_codec
+from backend.api.core.kline_arrays import KLINE_COLUMNS, KlineArrays
+from backend.api.core.kline_store import pa
+
+NDJSON = "application/x-ndjson"
+ARROW_STREAM = "application/vnd.apache.arrow.stream"
+STREAM_FORMATS = {
+    "ndjson": NDJSON,
+    "arrow": ARROW_STREAM,
+    "codec": kline_codec.MEDIA_TYPE,
+}
+
+
+def ndjson_chunks(chunks: Iterable[KlineArrays]) -> Iterator[bytes]:
+    # one json object per kline and line, written one chunk at a time
+    for klines in chunks:
+        if len(klines):
+            yield klines.to_frame().to_json(orient="records", lines=True).encode()
+
+
+def arrow_chunks(chunks: Iterable[KlineArrays]) -> Iterator[bytes]:
+    # an Arrow IPC stream, the schema first and then one record batch per chunk
+    schema = pa.schema(
+        [("time", pa.int64())] + [(c, pa.float64()) for c in KLINE_COLUMNS[1:]]
+    )
+    sink = io.BytesIO()
+    writer = pa.ipc.new_stream(sink, schema)
+    for klines in chunks:
+        if len(klines):
+            writer.write_batch(
+                pa.record_batch(
+                    [getattr(klines, c) for c in KLINE_COLUMNS], schema=schema
+                )
+            )
+            yield flush(sink)
+    writer.close()
+    yield flush(sink)
+
+
+def flush(sink: io.BytesIO) -> bytes:
+    data = sink.getvalue()
+    sink.seek(0)
+    sink.truncate()
+    return data
+
+
+def encode_chunks(stream: str, chunks: Iterable[KlineArrays]) -> Iterator[bytes]:
+    if stream == "arrow":
+        return arrow_chunks(chunks)
+    if stream == "codec":
+        return kline_codec.encode_stream(chunks)
+    return ndjson_chunks(chunks)
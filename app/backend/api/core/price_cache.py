@@ -0,0 +1,95 @@
+import asyncio
+import logging
+import os
+import threading
+import time
+from typing import Awaitable, Callable, Dict, List
+
+import httpx
+import redis
+
+from backend.api.core.redis_client import get_redis_client
+from backend.api.core.resilience import ExchangeError
+
+logger = logging.getLogger(__name__)
+
+PRICE_CACHE_TTL = float(os.environ.get("PRICE_CACHE_TTL", 10))
+# hash of the latest prices pushed by the market_stream ingestor, it expires
+# when the stream stops so it never serves prices older than that
+STREAM_PRICES_KEY = "market_stream:prices:{}"
+
+
+class PriceCache:
+    # Full ticker snapshot of one exchange. Lookups are dict reads while the
+    # snapshot is fresh; when it expires only one caller downloads it again
+    # and the concurrent callers wait for that same download. Prices of a
+    # running market stream win over the snapshot, and when they cover every
+    # requested symbol the exchange is not asked at all.
+
+    def __init__(self, ttl: float = PRICE_CACHE_TTL, stream_key: str = None):
+        self.ttl = ttl
+        self.stream_key = stream_key
+        self.prices: Dict[str, str] = {}
+        self.updated_at = 0.0
+        self.lock = threading.Lock()
+        self.async_lock = None
+
+    def is_fresh(self) -> bool:
+        return bool(self.prices) and time.monotonic() - self.updated_at < self.ttl
+
+    def update(self, prices: Dict[str, str]):
+        self.prices = prices
+        self.updated_at = time.monotonic()
+
+    def serve_stale(self, error: Exception):
+        # while the exchange fails the last snapshot is better than nothing,
+        # it stays expired so the next caller tries the exchange again
+        if not self.prices:
+            raise error
+        age = time.monotonic() - self.updated_at
+        logger.warning(f"serving {age:.0f}s old prices: {error}")
+
+    def streamed(self) -> Dict[str, str]:
+        if self.stream_key is None:
+            return {}
+        try:
+            prices = get_redis_client().hgetall(self.stream_key)
+        except redis.RedisError as e:
+            logger.warning(f"streamed prices unavailable: {e!r}")
+            return {}
+        return {k.decode(): v.decode() for k, v in prices.items()}
+
+    def get(
+        self, loader: Callable[[], Dict[str, str]], keys: List[str] = None
+    ) -> Dict[str, str]:
+        streamed = self.streamed()
+        if streamed and keys is not None and all(k in streamed for k in keys):
+            return streamed
+        if not self.is_fresh():
+            with self.lock:
+                if not self.is_fresh():
+                    try:
+                        self.update(loader())
+                    except (ExchangeError, httpx.HTTPError) as e:
+                        self.serve_stale(e)
+        return {**self.prices, **streamed}
+
+    async def get_async(
+        self, loader: Callable[[], Awaitable[Dict[str, str]]], keys: List[str] = None
+    ) -> Dict[str, str]:
+        # the redis client blocks, it is read off the event loop
+        streamed = await asyncio.get_running_loop().run_in_executor(
+            None, self.streamed
+        )
+        if streamed and keys is not None and all(k in streamed for k in keys):
+            return streamed
+        if not self.is_fresh():
+            if self.async_lock is None:
+                self.async_lock = asyncio.Lock()
+            async with self.async_lock:
+                if not self.is_fresh():
+                    try:
+                        self.update(await loader())
+                    except (ExchangeError, httpx.HTTPError) as e:
+                        self.serve_stale(e)
+        return {**self.prices, **streamed}
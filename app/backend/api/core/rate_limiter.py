@@ -0,0 +1,140 @@
+import asyncio
+import logging
+import os
+import threading
+import time
+from typing import Dict, Tuple
+
+import redis
+
+from backend.api.core.redis_client import get_redis_client
+
+logger = logging.getLogger(__name__)
+
+# keep the budget a bit under the published limits so clock skew and
+# requests made outside of these clients never push us over
+RATE_LIMIT_HEADROOM = float(os.environ.get("RATE_LIMIT_HEADROOM", 0.9))
+RATE_LIMIT_RETRIES = 3
+
+# (weight budget, period in seconds) per exchange
+RATE_LIMITS: Dict[str, Tuple[int, int]] = {
+    "KuCoin": (2000, 30),
+    "MEXC": (500, 10),
+}
+
+ENDPOINT_WEIGHTS: Dict[str, Dict[str, int]] = {
+    "KuCoin": {
+        "/api/v1/market/candles": 3,
+        "/api/v2/symbols": 4,
+        "/api/v1/prices": 3,
+        "/api/v1/accounts": 5,
+        "/api/v1/fills": 10,
+    },
+    "MEXC": {
+        "/api/v3/klines": 1,
+        "/api/v3/defaultSymbols": 1,
+        "/api/v3/ticker/price": 2,
+        "/api/v3/account": 10,
+        "/api/v3/allOrders": 10,
+        "/api/v3/trades": 5,
+    },
+}
+DEFAULT_WEIGHT = 1
+
+# Every call takes its weight right away, even when the bucket goes below
+# zero, and gets back how long it has to wait for the debt to refill. This
+# makes the bucket a queue: callers are served in arrival order and none of
+# them is rejected.
+TOKEN_BUCKET_SCRIPT = """
+local capacity = tonumber(ARGV[1])
+local rate = tonumber(ARGV[2])
+local weight = tonumber(ARGV[3])
+local now_t = redis.call('TIME')
+local now = tonumber(now_t[1]) + tonumber(now_t[2]) / 1000000
+local bucket = redis.call('HMGET', KEYS[1], 'tokens', 'ts')
+local tokens = tonumber(bucket[1]) or capacity
+local ts = tonumber(bucket[2]) or now
+tokens = math.min(capacity, tokens + (now - ts) * rate) - weight
+redis.call('HSET', KEYS[1], 'tokens', tokens, 'ts', now)
+redis.call('EXPIRE', KEYS[1], math.ceil(capacity / rate) * 2)
+if tokens >= 0 then
+    return '0'
+end
+return tostring(-tokens / rate)
+"""
+
+
+class LocalTokenBucket:
+    def __init__(self, capacity: float, rate: float):
+        self.capacity = capacity
+        self.rate = rate
+        self.tokens = capacity
+        self.ts = time.monotonic()
+        self.lock = threading.Lock()
+
+    def reserve(self, weight: int) -> float:
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(
+                self.capacity, self.tokens + (now - self.ts) * self.rate
+            )
+            self.tokens -= weight
+            self.ts = now
+            if self.tokens >= 0:
+                return 0.0
+            return -self.tokens / self.rate
+
+
+class RedisTokenBucket:
+    def __init__(self, key: str, capacity: float, rate: float):
+        self.key = key
+        self.capacity = capacity
+        self.rate = rate
+        self.script = get_redis_client().register_script(TOKEN_BUCKET_SCRIPT)
+
+    def reserve(self, weight: int) -> float:
+        wait = self.script(keys=[self.key], args=[self.capacity, self.rate, weight])
+        return float(wait)
+
+
+class RateLimiter:
+    def __init__(self, exchange_name: str):
+        self.exchange_name = exchange_name
+        limit, period = RATE_LIMITS.get(exchange_name, (100, 10))
+        capacity = limit * RATE_LIMIT_HEADROOM
+        rate = capacity / period
+        self.weights = ENDPOINT_WEIGHTS.get(exchange_name, {})
+        self.local_bucket = LocalTokenBucket(capacity, rate)
+        self.bucket = RedisTokenBucket(f"ratelimit:{exchange_name}", capacity, rate)
+
+    def reserve(self, endpoint: str) -> float:
+        weight = self.weights.get(endpoint, DEFAULT_WEIGHT)
+        try:
+            return self.bucket.reserve(weight)
+        except redis.exceptions.RedisError as e:
+            # without redis every process keeps its own budget
+            logger.warning(f"rate limiter redis unavailable, using local bucket: {e}")
+            return self.local_bucket.reserve(weight)
+
+    def acquire(self, endpoint: str):
+        wait = self.reserve(endpoint)
+        if wait > 0:
+            logger.info(f"{self.exchange_name} rate limit, waiting {wait:.2f}s")
+            time.sleep(wait)
+
+    async def acquire_async(self, endpoint: str):
+        # the redis client blocks, the reservation runs off the event loop
+        wait = await asyncio.get_running_loop().run_in_executor(
+            None, self.reserve, endpoint
+        )
+        if wait > 0:
+            logger.info(f"{self.exchange_name} rate limit, waiting {wait:.2f}s")
+            await asyncio.sleep(wait)
+
+    def retry_after(self, response) -> float:
+        # seconds to wait after the exchange answered 429
+        if "Retry-After" in response.headers:
+            return float(response.headers["Retry-After"])
+        if "gw-ratelimit-reset" in response.headers:
+            return int(response.headers["gw-ratelimit-reset"]) / 1000
+        return RATE_LIMITS.get(self.exchange_name, (100, 10))[1]
@@ -0,0 +1,23 @@
+import os
+
+import redis
+
+# the redis deployed as the celery broker is also used for state shared
+# between the API and the workers (rate limits, caches, catalogs)
+REDIS_URL = os.environ.get(
+    "REDIS_URL", os.environ.get("CELERY_BROKER_URL", "redis://localhost:6379")
+)
+# seconds before a call to an unreachable redis fails, callers fall back
+# instead of hanging (rate limiter local bucket, database catalogs)
+REDIS_TIMEOUT = float(os.environ.get("REDIS_TIMEOUT", 2))
+
+_redis_client = None
+
+
+def get_redis_client() -> redis.Redis:
+    global _redis_client
+    if _redis_client is None:
+        _redis_client = redis.Redis.from_url(
+            REDIS_URL, socket_timeout=REDIS_TIMEOUT, socket_connect_timeout=REDIS_TIMEOUT
+        )
+    return _redis_client
@@ -0,0 +1,173 @@
+import logging
+import os
+import random
+import threading
+import time
+from typing import Dict
+
+import httpx
+
+logger = logging.getLogger(__name__)
+
+EXCHANGE_RETRIES = int(os.environ.get("EXCHANGE_RETRIES", 2))
+EXCHANGE_BACKOFF = float(os.environ.get("EXCHANGE_BACKOFF", 0.25))
+EXCHANGE_BACKOFF_MAX = 5.0
+EXCHANGE_HEDGING = os.environ.get("EXCHANGE_HEDGING", "false").lower() == "true"
+CIRCUIT_FAILURES = int(os.environ.get("CIRCUIT_FAILURES", 5))
+CIRCUIT_RESET_TIMEOUT = float(os.environ.get("CIRCUIT_RESET_TIMEOUT", 30))
+
+DEFAULT_TIMEOUT = httpx.Timeout(10.0, connect=3.0)
+ENDPOINT_TIMEOUTS: Dict[str, Dict[str, httpx.Timeout]] = {
+    "KuCoin": {
+        "/api/v1/prices": httpx.Timeout(5.0, connect=2.0),
+        "/api/v1/accounts": httpx.Timeout(5.0, connect=2.0),
+        "/api/v1/market/candles": httpx.Timeout(15.0, connect=3.0),
+        "/api/v2/symbols": httpx.Timeout(20.0, connect=3.0),
+    },
+    "MEXC": {
+        "/api/v3/ticker/price": httpx.Timeout(5.0, connect=2.0),
+        "/api/v3/account": httpx.Timeout(5.0, connect=2.0),
+        "/api/v3/klines": httpx.Timeout(15.0, connect=3.0),
+        "/api/v3/defaultSymbols": httpx.Timeout(20.0, connect=3.0),
+    },
+}
+
+# seconds to wait for a GET before sending the same request a second time,
+# only for small idempotent calls where the tail latency shows in the UI
+HEDGE_DELAYS: Dict[str, Dict[str, float]] = {
+    "KuCoin": {
+        "/api/v1/prices": 0.5,
+        "/api/v1/accounts": 0.5,
+    },
+    "MEXC": {
+        "/api/v3/ticker/price": 0.5,
+        "/api/v3/account": 0.5,
+    },
+}
+
+# endpoints whose last good response is served while the exchange is failing
+STALE_ENDPOINTS = {
+    "/api/v1/prices",
+    "/api/v1/accounts",
+    "/api/v2/symbols",
+    "/api/v3/ticker/price",
+    "/api/v3/account",
+    "/api/v3/defaultSymbols",
+}
+
+
+class ExchangeError(Exception):
+    pass
+
+
+class ExchangeAPIError(ExchangeError):
+    def __init__(self, exchange: str, endpoint: str, response: httpx.Response):
+        self.response = response
+        super().__init__(
+            f"{exchange} {endpoint} answered {response.status_code}: "
+            f"{response.text[:200]}"
+        )
+
+
+class CircuitOpenError(ExchangeError):
+    pass
+
+
+def timeout_for(exchange: str, endpoint: str) -> httpx.Timeout:
+    return ENDPOINT_TIMEOUTS.get(exchange, {}).get(endpoint, DEFAULT_TIMEOUT)
+
+
+def hedge_delay(exchange: str, method: str, endpoint: str) -> float | None:
+    if not EXCHANGE_HEDGING or method != "GET":
+        return None
+    return HEDGE_DELAYS.get(exchange, {}).get(endpoint)
+
+
+def retries_for(method: str) -> int:
+    # only GETs are idempotent, a POST is never sent twice
+    return EXCHANGE_RETRIES if method == "GET" else 0
+
+
+def backoff_delay(attempt: int) -> float:
+    # full jitter, so clients that failed together do not retry together
+    return random.uniform(0, min(EXCHANGE_BACKOFF_MAX, EXCHANGE_BACKOFF * 2**attempt))
+
+
+def is_retryable(response: httpx.Response) -> bool:
+    return response.status_code >= 500
+
+
+def stale_key(endpoint: str, params: dict | None) -> tuple | None:
+    if endpoint not in STALE_ENDPOINTS:
+        return None
+    # signed requests change timestamp and signature on every call
+    params = params or {}
+    return endpoint, tuple(
+        sorted(
+            (k, str(v)) for k, v in params.items() if k not in ("timestamp", "signature")
+        )
+    )
+
+
+class CircuitBreaker:
+    # After CIRCUIT_FAILURES failures in a row calls fail fast for
+    # CIRCUIT_RESET_TIMEOUT seconds, then one call is let through to probe
+    # the exchange and its result closes or opens the circuit again.
+
+    def __init__(self, name: str):
+        self.name = name
+        self.failures = 0
+        self.opened_at = None
+        self.probing = False
+        self.lock = threading.Lock()
+
+    @property
+    def state(self) -> str:
+        if self.opened_at is None:
+            return "closed"
+        if time.monotonic() - self.opened_at < CIRCUIT_RESET_TIMEOUT:
+            return "open"
+        return "half-open"
+
+    def check(self) -> bool:
+        """raise CircuitOpenError unless the call may go through, True when
+        the call is the half-open probe"""
+        with self.lock:
+            state = self.state
+            if state == "closed":
+                return False
+            if state == "half-open" and not self.probing:
+                self.probing = True
+                return True
+        raise CircuitOpenError(f"{self.name} circuit is {state}")
+
+    def release(self):
+        # the probe ended without a result (cancelled, an unexpected error),
+        # the next call probes again
+        with self.lock:
+            self.probing = False
+
+    def record_success(self):
+        with self.lock:
+            self.failures = 0
+            self.opened_at = None
+            self.probing = False
+
+    def record_failure(self):
+        with self.lock:
+            self.failures += 1
+            if self.probing or self.failures >= CIRCUIT_FAILURES:
+                if self.opened_at is None or self.probing:
+                    logger.warning(f"{self.name} circuit opened")
+                self.opened_at = time.monotonic()
+                self.probing = False
+
+
+_circuit_breakers: Dict[str, CircuitBreaker] = {}
+
+
+def get_circuit_breaker(exchange: str) -> CircuitBreaker:
+    # one breaker per exchange and process, shared by sync and async clients
+    if exchange not in _circuit_breakers:
+        _circuit_breakers[exchange] = CircuitBreaker(exchange)
+    return _circuit_breakers[exchange]
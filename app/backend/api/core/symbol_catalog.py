@@ -0,0 +1,161 @@
+import logging
+from typing import Dict, List, Tuple
+
+from sqlalchemy import (
+    Table,
+    and_,
+    delete,
+    exists,
+    func,
+    insert,
+    inspect,
+    select,
+    update,
+)
+from sqlalchemy.engine import Connection, Engine
+from sqlalchemy.orm import Session
+
+from backend.api.core.kline_ingest import UPSERT_DIALECTS
+from backend.api.core.symbol_registry import SymbolPairs
+from backend.api.models.crypto import (
+    Kline,
+    KlineCoverage,
+    KlineWatermark,
+    Pair,
+    Symbol,
+)
+
+logger = logging.getLogger(__name__)
+
+PAIR_KEY = ["exchange_id", "name"]
+SYMBOL_KEY = ["exchange_id", "name", "pair_id"]
+# tables pointing at a symbol: column and the columns that, with it, are
+# unique in that table
+SYMBOL_REFERENCES = [
+    (Kline.__table__, "symbol_id", ["interval_id", "time"]),
+    (KlineCoverage.__table__, "symbol_id", None),
+    (KlineWatermark.__table__, "symbol_id", ["interval_id"]),
+]
+PAIR_REFERENCES = [(Symbol.__table__, "pair_id", None)]
+
+
+def insert_ignore(dialect: str, table: Table, key: List[str]):
+    # rows already stored, maybe by a concurrent sync, are skipped
+    if dialect not in UPSERT_DIALECTS:
+        return insert(table)
+    return UPSERT_DIALECTS[dialect](table).on_conflict_do_nothing(index_elements=key)
+
+
+def load_pairs(db: Session, exchange_id: int) -> Dict[str, int]:
+    rows = db.query(Pair.name, Pair.id).filter(Pair.exchange_id == exchange_id)
+    return dict(rows.all())
+
+
+def insert_symbol_pairs(db: Session, exchange_id: int, symbols: SymbolPairs) -> int:
+    """store the (symbol, pair) tuples not stored yet, one query per table
+    to read what exists and one bulk insert per table, returns the number of
+    new symbols"""
+    if not symbols:
+        return 0
+    dialect = db.get_bind().dialect.name
+    pairs = load_pairs(db, exchange_id)
+    new_pairs = {pair for _, pair in symbols} - pairs.keys()
+    if new_pairs:
+        db.execute(
+            insert_ignore(dialect, Pair.__table__, PAIR_KEY),
+            [{"exchange_id": exchange_id, "name": p} for p in new_pairs],
+        )
+        pairs = load_pairs(db, exchange_id)
+    existing = set(
+        db.query(Symbol.name, Symbol.pair_id)
+        .filter(Symbol.exchange_id == exchange_id)
+        .all()
+    )
+    new_symbols = {(symbol, pairs[pair]) for symbol, pair in symbols} - existing
+    if new_symbols:
+        db.execute(
+            insert_ignore(dialect, Symbol.__table__, SYMBOL_KEY),
+            [
+                {"exchange_id": exchange_id, "name": symbol, "pair_id": pair_id}
+                for symbol, pair_id in new_symbols
+            ],
+        )
+    db.commit()
+    return len(new_symbols)
+
+
+def duplicate_groups(
+    connection: Connection, table: Table, key: List[str]
+) -> List[Tuple[int, List[int]]]:
+    # (oldest id, the other ids) of the rows sharing a key
+    columns = [table.c[c] for c in key]
+    groups = connection.execute(
+        select(func.min(table.c.id), *columns)
+        .group_by(*columns)
+        .having(func.count() > 1)
+    ).all()
+    duplicates = []
+    for keep, *values in groups:
+        ids = connection.execute(
+            select(table.c.id).where(
+                *[c == v for c, v in zip(columns, values)], table.c.id != keep
+            )
+        ).scalars()
+        duplicates.append((keep, list(ids)))
+    return duplicates
+
+
+def repoint(
+    connection: Connection,
+    table: Table,
+    column: str,
+    unique_with: List[str] | None,
+    old: int,
+    new: int,
+):
+    # rows of `old` that `new` already has are dropped, the rest move to `new`
+    if unique_with:
+        kept = table.alias("kept")
+        connection.execute(
+            delete(table).where(
+                table.c[column] == old,
+                exists().where(
+                    kept.c[column] == new,
+                    and_(*[kept.c[c] == table.c[c] for c in unique_with]),
+                ),
+            )
+        )
+    connection.execute(
+        update(table).where(table.c[column] == old).values({column: new})
+    )
+
+
+def merge_duplicates(
+    connection: Connection, table: Table, key: List[str], references: list
+) -> int:
+    merged = 0
+    for keep, ids in duplicate_groups(connection, table, key):
+        for duplicate in ids:
+            for reference, column, unique_with in references:
+                repoint(connection, reference, column, unique_with, duplicate, keep)
+        connection.execute(delete(table).where(table.c.id.in_(ids)))
+        merged += len(ids)
+    return merged
+
+
+def merge_duplicate_catalog(engine: Engine):
+    """merge the duplicate pairs and symbols written before their unique
+    indexes existed into the oldest row, moving what points at them, so the
+    indexes can be created without dropping klines"""
+    inspector = inspect(engine)
+    if not inspector.has_table("symbols") or not inspector.has_table("pairs"):
+        return
+    indexes = {index["name"] for index in inspector.get_indexes("symbols")}
+    if "ix_symbols_exchange_name_pair" in indexes:
+        return
+    with engine.begin() as connection:
+        pairs = merge_duplicates(connection, Pair.__table__, PAIR_KEY, PAIR_REFERENCES)
+        symbols = merge_duplicates(
+            connection, Symbol.__table__, SYMBOL_KEY, SYMBOL_REFERENCES
+        )
+    logger.info(f"merged {pairs} duplicate pairs and {symbols} duplicate symbols")
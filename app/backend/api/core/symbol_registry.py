@@ -0,0 +1,65 @@
+import hashlib
+import logging
+from typing import Dict, Set, Tuple
+
+import redis
+
+from backend.api.core.redis_client import get_redis_client
+
+logger = logging.getLogger(__name__)
+
+SymbolPairs = Set[Tuple[str, str]]
+
+
+def fingerprint_payload(payload: bytes) -> str:
+    return hashlib.sha256(payload).hexdigest()
+
+
+class SymbolRegistry:
+    # Current symbol catalog of every exchange as (symbol, pair) tuples. The
+    # catalog lives in redis so the API and the workers see the same one, each
+    # process keeps an in-memory copy that is reloaded only when the version
+    # counter in redis moved.
+
+    def __init__(self, redis_client: redis.Redis = None):
+        self.redis = redis_client or get_redis_client()
+        self.catalogs: Dict[str, SymbolPairs] = {}
+        self.versions: Dict[str, int] = {}
+
+    def fingerprint(self, exchange: str) -> str | None:
+        fingerprint = self.redis.get(f"symbols:fingerprint:{exchange}")
+        return fingerprint.decode() if fingerprint else None
+
+    def symbols(self, exchange: str) -> SymbolPairs:
+        version = int(self.redis.get(f"symbols:version:{exchange}") or 0)
+        if self.versions.get(exchange) != version:
+            members = self.redis.smembers(f"symbols:catalog:{exchange}")
+            self.catalogs[exchange] = {
+                tuple(member.decode().split("/", 1)) for member in members
+            }
+            self.versions[exchange] = version
+        return self.catalogs[exchange]
+
+    def diff(self, exchange: str, symbols: SymbolPairs) -> Tuple[SymbolPairs, SymbolPairs]:
+        current = self.symbols(exchange)
+        return symbols - current, current - symbols
+
+    def update(
+        self,
+        exchange: str,
+        fingerprint: str,
+        added: SymbolPairs,
+        removed: SymbolPairs,
+    ):
+        pipeline = self.redis.pipeline()
+        if added:
+            pipeline.sadd(
+                f"symbols:catalog:{exchange}", *[f"{s}/{p}" for s, p in added]
+            )
+        if removed:
+            pipeline.srem(
+                f"symbols:catalog:{exchange}", *[f"{s}/{p}" for s, p in removed]
+            )
+        pipeline.set(f"symbols:fingerprint:{exchange}", fingerprint)
+        pipeline.incr(f"symbols:version:{exchange}")
+        pipeline.execute()
@@ -0,0 +1,80 @@
+import argparse
+import logging
+from typing import Iterator, Tuple
+
+from sqlalchemy import Index, MetaData, Table, delete, func, inspect, select
+from sqlalchemy.engine import Connection, Engine
+
+logger = logging.getLogger(__name__)
+
+# create_all does not touch existing tables, unique indexes added to a model
+# later are created at startup when the table holds no duplicates. Dropping
+# the duplicates can delete many klines, it is never done at startup, run
+# `python -m backend.api.core.unique_indexes deduplicate` once by hand.
+
+
+def missing_unique_indexes(
+    engine: Engine, metadata: MetaData
+) -> Iterator[Tuple[Table, Index]]:
+    inspector = inspect(engine)
+    for table in metadata.sorted_tables:
+        existing = {index["name"] for index in inspector.get_indexes(table.name)}
+        for index in table.indexes:
+            if index.unique and index.name not in existing:
+                yield table, index
+
+
+def duplicate_rows(table: Table, index: Index):
+    # the most recently written row of every key is kept
+    keep = select(func.max(table.c.id)).group_by(*index.columns)
+    return table.c.id.not_in(keep)
+
+
+def count_duplicates(connection: Connection, table: Table, index: Index) -> int:
+    return connection.execute(
+        select(func.count()).select_from(table).where(duplicate_rows(table, index))
+    ).scalar()
+
+
+def create_unique_indexes(engine: Engine, metadata: MetaData):
+    """create the missing unique indexes of tables without duplicates"""
+    for table, index in missing_unique_indexes(engine, metadata):
+        with engine.begin() as connection:
+            duplicates = count_duplicates(connection, table, index)
+            if duplicates:
+                logger.warning(
+                    f"{index.name} not created, {table.name} holds {duplicates} "
+                    f"duplicate rows, run python -m backend.api.core.unique_indexes "
+                    f"deduplicate"
+                )
+                continue
+            index.create(connection)
+        logger.info(f"created {index.name}")
+
+
+def deduplicate(engine: Engine, metadata: MetaData):
+    """drop the duplicate rows blocking the missing unique indexes and
+    create them"""
+    for table, index in missing_unique_indexes(engine, metadata):
+        with engine.begin() as connection:
+            duplicates = count_duplicates(connection, table, index)
+            logger.info(
+                f"{index.name}: deleting {duplicates} duplicate rows of {table.name}"
+            )
+            connection.execute(delete(table).where(duplicate_rows(table, index)))
+            index.create(connection)
+        logger.info(f"created {index.name}")
+
+
+if __name__ == "__main__":
+    from backend.api.database import engine
+
+    # the models register their tables, only crypto ones have unique indexes
+    from backend.api.models.crypto import Base
+
+    parser = argparse.ArgumentParser(description="missing unique indexes")
+    parser.add_argument("command", choices=["deduplicate"])
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+
+    deduplicate(engine, Base.metadata)
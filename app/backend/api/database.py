@@ -2,9 +2,9 @@ from sqlalchemy import create_engine
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker
 
+from backend.api.core.unique_indexes import create_unique_indexes
 from backend.config import SQLALCHEMY_DATABASE_URL
 
-
 engine = create_engine(SQLALCHEMY_DATABASE_URL)
 
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
@@ -22,3 +22,4 @@ def get_db():
 
 def create_database():
     Base.metadata.create_all(bind=engine)
+    create_unique_indexes(engine, Base.metadata)
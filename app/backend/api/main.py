@@ -6,11 +6,15 @@ from icecream import ic
 
 from backend.api import create_access_token, verify_token
 from backend.api.core.exchanges_clients import (
+    AsyncExchangeClient,
+    AsyncKuCoinClient,
+    AsyncMexcClient,
     ExchangeClient,
     KuCoinClient,
     MexcClient,
     CryptoRankClient,
 )
+from backend.api.core.symbol_registry import SymbolRegistry
 from backend.api.models import crypto
 from backend.api.models.crypto import Exchange
 from backend.api.sheets import create_drive_folder, get_google_services
@@ -38,7 +42,8 @@ from backend.config import (
 )
 from pyotp import TOTP
 from uuid import uuid4
-from backend.api.database import create_database, get_db
+from backend.api.database import create_database, engine, get_db
+from backend.api.core.symbol_catalog import merge_duplicate_catalog
 from fastapi.security import OAuth2PasswordBearer
 from backend.api.log import logger
 
@@ -124,6 +129,8 @@ def startup_event():
     db = get_db()
     from backend.api.models import goals
 
+    # duplicates are merged before create_database adds the unique indexes
+    merge_duplicate_catalog(engine)
     create_database()
 
     def get_or_add_exchanges(db):
@@ -224,6 +231,7 @@ def startup_event():
     app.state.crypto_clients: Dict[str, ExchangeClient] = dict()
     app.state.ticktick_client = ticktick_client
     app.state.crypto_rank_client = crypto_rank_client
+    app.state.symbol_registry = SymbolRegistry()
     app.state.crypto_clients[kucoin_exchange.name] = KuCoinClient(
         id=kucoin_exchange.id,
         name=kucoin_exchange.name,
@@ -240,10 +248,32 @@ def startup_event():
         api_secret=mexc_exchange.secret_key,
         base_url=mexc_exchange.base_url,
     )
+    app.state.async_crypto_clients: Dict[str, AsyncExchangeClient] = dict()
+    app.state.async_crypto_clients[kucoin_exchange.name] = AsyncKuCoinClient(
+        id=kucoin_exchange.id,
+        name=kucoin_exchange.name,
+        api_key=kucoin_exchange.api_key,
+        api_secret=kucoin_exchange.secret_key,
+        passphrase=kucoin_exchange.passphrase,
+        base_url=kucoin_exchange.base_url,
+    )
+    app.state.async_crypto_clients[mexc_exchange.name] = AsyncMexcClient(
+        id=mexc_exchange.id,
+        name=mexc_exchange.name,
+        api_key=mexc_exchange.api_key,
+        api_secret=mexc_exchange.secret_key,
+        base_url=mexc_exchange.base_url,
+    )
     app.state.github_client = github_client
     app.state.totp = TOTP(OPT_KEY)
 
 
+@app.on_event("shutdown")
+async def shutdown_event():
+    for client in app.state.async_crypto_clients.values():
+        await client.aclose()
+
+
 @app.get("/health")
 def health_check():
     return {"status": "ok"}
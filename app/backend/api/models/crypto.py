@@ -10,6 +10,7 @@ from sqlalchemy import (
     text,
     Double,
     ForeignKey,
+    Index,
 )
 from sqlalchemy.orm import relationship
 
@@ -80,6 +81,17 @@ class Symbol(Base):
     name = Column(String, nullable=False)  # BTC or ETH
     pair_id = Column(Integer, nullable=False)
 
+    # one row per exchange symbol, concurrent syncs insert it only once
+    __table_args__ = (
+        Index(
+            "ix_symbols_exchange_name_pair",
+            "exchange_id",
+            "name",
+            "pair_id",
+            unique=True,
+        ),
+    )
+
 
 class Pair(Base):
     __tablename__ = "pairs"
@@ -87,6 +99,10 @@ class Pair(Base):
     exchange_id = Column(Integer, nullable=False)
     name = Column(String, nullable=False)  # USDT or USD
 
+    __table_args__ = (
+        Index("ix_pairs_exchange_name", "exchange_id", "name", unique=True),
+    )
+
 
 class Balance(Base):
     __tablename__ = "balances"
@@ -119,12 +135,60 @@ class Kline(Base):
     volume = Column(Double, nullable=False)
     quote_asset_volume = Column(Double, nullable=True)
 
+    # one candle per symbol, interval and open time; range queries on a
+    # symbol and interval are scans of this index
+    __table_args__ = (
+        Index(
+            "ix_klines_symbol_interval_time",
+            "symbol_id",
+            "interval_id",
+            "time",
+            unique=True,
+        ),
+    )
+
     # save the kline data in the database
     # we can use this data to backtest the strategy
     # and also use it to display the chart
     # we can also use it to calculate the indicators
 
 
+class KlineCoverage(Base):
+    # time ranges [start, end) of one symbol and interval whose klines are
+    # all stored, merged so ranges of a series never overlap or touch
+    __tablename__ = "kline_coverage"
+
+    id = Column(Integer, primary_key=True, nullable=False)
+    symbol_id = Column(Integer, nullable=False)
+    interval_id = Column(Integer, nullable=False)
+    start = Column(Integer, nullable=False)
+    end = Column(Integer, nullable=False)
+
+    __table_args__ = (
+        Index("ix_kline_coverage_symbol_interval", "symbol_id", "interval_id"),
+    )
+
+
+class KlineWatermark(Base):
+    # tracked symbol and interval kept current by the follow task, `time` is
+    # the open time of the newest stored kline, null until the first run
+    __tablename__ = "kline_watermarks"
+
+    id = Column(Integer, primary_key=True, nullable=False)
+    symbol_id = Column(Integer, nullable=False)
+    interval_id = Column(Integer, nullable=False)
+    time = Column(Integer, nullable=True)
+
+    __table_args__ = (
+        Index(
+            "ix_kline_watermarks_symbol_interval",
+            "symbol_id",
+            "interval_id",
+            unique=True,
+        ),
+    )
+
+
 class KlinesBase(BaseModel):
     time: int
     open: float
@@ -1,32 +1,49 @@
+import asyncio
 from datetime import datetime
 from googleapiclient.http import MediaFileUpload, MediaIoBaseDownload
 import io
-from typing import Dict, List
+from typing import Awaitable, Dict, List
+import httpx
 from icecream import ic
+import redis
 from fastapi import APIRouter, BackgroundTasks, Depends, HTTPException, Request
+from fastapi.responses import StreamingResponse
 from pydantic import BaseModel
 from backend.api.models.crypto import (
     Exchange,
     ExchangeSymbols,
     Interval,
-    Kline,
     KlinesBase,
     Pair,
     Symbol,
-    SymbolBase,
     SymbolPair,
 )
 from backend.config import DRIVE_CRYPTO_FOLDER, SCOPES, SPREADSHEET_CRYPTO_ID
 from backend.api.core.exchanges_clients import (
-    GENERAL_KLINE_INTERVALS,
+    AsyncKuCoinClient,
+    AsyncMexcClient,
     KuCoinClient,
     MexcClient,
 )
+from backend.api.core.kline_coverage import KlineCoverageIndex, fetch_missing_klines
+from backend.api.core.kline_downsample import DOWNSAMPLE_MODES, downsample_klines
+from backend.api.core.kline_follow import KlineWatermarks
+from backend.api.core.kline_resample import resample_stored_klines
+from backend.api.core.kline_store import (
+    KLINE_CHUNK_SIZE,
+    KlineSeries,
+    get_kline_store,
+    pa,
+    split_klines,
+)
+from backend.api.core.kline_stream import STREAM_FORMATS, encode_chunks
+from backend.api.core.resilience import ExchangeError
+from backend.api.core.symbol_registry import SymbolRegistry
 from backend.api.sheets import pull_sheet_data
 import pandas as pd
 from dateutil import parser
 import tempfile
-from backend.celery_t.worker import get_symbol_klines as get_symbol_klines_task
+from backend.celery_t.worker import backfill_progress, backfill_symbol_klines
 from backend.api.log import logger
 
 router = APIRouter(prefix="/crypto", tags=["crypto"])
@@ -47,6 +64,14 @@ def get_mex_client(request: Request):
     return request.app.state.crypto_clients["MEXC"]
 
 
+def get_async_kucoin_client(request: Request):
+    return request.app.state.async_crypto_clients["KuCoin"]
+
+
+def get_async_mexc_client(request: Request):
+    return request.app.state.async_crypto_clients["MEXC"]
+
+
 @router.get("/all")
 def get_crypto_entries(request: Request):
     # Read entries from google sheets
@@ -101,33 +126,43 @@ def get_exchange_client(request: Request, exchange_name: str):
     return request.app.state.crypto_clients[exchange_name]
 
 
+def get_db_symbol_pairs(db, exchange: Exchange):
+    pairs_db = db.query(Pair).filter(Pair.exchange_id == exchange.id).all()
+    pairs_ids = [pair.id for pair in pairs_db]
+    pairs_dict = {p.id: p for p in pairs_db}
+    symbols = (
+        db.query(Symbol)
+        .filter(Symbol.exchange_id == exchange.id, Symbol.pair_id.in_(pairs_ids))
+        .all()
+    )
+    return {(s.name, pairs_dict[s.pair_id].name) for s in symbols}
+
+
 @router.get("/all_symbols", response_model=List[ExchangeSymbols])
 def get_all_tickers(request: Request, db=Depends(get_db)):
     # group exchange symbols and get them from the exchanges
     exchanges = db.query(Exchange).all()
+    symbol_registry: SymbolRegistry = request.app.state.symbol_registry
     response = []
-    # group symbols by exchange
-    symbols_by_exchange = {}
     for exchange in exchanges:
-        pairs_db = db.query(Pair).filter(Pair.exchange_id == exchange.id).all()
-        pairs_ids = [pair.id for pair in pairs_db]
-        pairs_dict = {p.id: p for p in pairs_db}
-        symbols = (
-            db.query(Symbol)
-            .filter(Symbol.exchange_id == exchange.id, Symbol.pair_id.in_(pairs_ids))
-            .all()
-        )
-        logger.info(f"symbols: {symbols[0]}")
+        # the catalog comes from the registry, the database is only read
+        # until the first symbol sync filled it or while redis is down
+        try:
+            symbol_pairs = symbol_registry.symbols(exchange.name)
+        except redis.RedisError as e:
+            logger.error(f"{exchange.name} symbol registry unavailable: {e}")
+            symbol_pairs = None
+        if not symbol_pairs:
+            symbol_pairs = get_db_symbol_pairs(db, exchange)
         intervals: List[Interval] = (
             db.query(Interval).filter(Interval.exchange_id == exchange.id).all()
         )
-        exchange_client = get_exchange_client(request, exchange.name)
 
         s_be = {}
-        for s in symbols:
-            if s.name not in s_be.keys():
-                s_be[s.name] = []
-            s_be[s.name].append(pairs_dict[s.pair_id].name)
+        for symbol, pair in sorted(symbol_pairs):
+            if symbol not in s_be.keys():
+                s_be[symbol] = []
+            s_be[symbol].append(pair)
         symbols_by_exchange = [SymbolPair(symbol=s, pairs=s_be[s]) for s in s_be.keys()]
 
         intervals = [it.name for it in intervals]
@@ -141,22 +176,31 @@ def get_all_tickers(request: Request, db=Depends(get_db)):
     return response
 
 
+async def exchange_or_empty(exchange: str, call: Awaitable, empty=None):
+    # one exchange being down or its circuit open must not fail the response
+    # for the others, its part is left empty. ValueError and KeyError are an
+    # unexpected body: not json or without the fields read from it
+    try:
+        return await call
+    except (ExchangeError, httpx.HTTPError, ValueError, KeyError) as e:
+        logger.error(f"{exchange} unavailable: {e}")
+        return {} if empty is None else empty
+
+
 @router.get("/orders")
-def get_orders(
-    kucoin_client: KuCoinClient = Depends(get_kucoin_client),
-    mexc_client: MexcClient = Depends(get_mex_client),
+async def get_orders(
+    kucoin_client: AsyncKuCoinClient = Depends(get_async_kucoin_client),
+    mexc_client: AsyncMexcClient = Depends(get_async_mexc_client),
 ):
-    r_kucoin_orders = kucoin_client.get_all_orders()
-    r_mex_orders = mexc_client.get_all_orders()
+    r_kucoin_orders, r_mex_orders = await asyncio.gather(
+        exchange_or_empty(kucoin_client.name, kucoin_client.get_all_orders()),
+        exchange_or_empty(mexc_client.name, mexc_client.get_all_orders(), []),
+    )
     return {"kucoin": r_kucoin_orders, "mexc": r_mex_orders}
 
 
-@router.get("/account")
-def get_account(
-    kucoin_client: KuCoinClient = Depends(get_kucoin_client),
-    mexc_client: MexcClient = Depends(get_mex_client),
-):
-    r_kucoin_account = kucoin_client.get_account_summary()
+async def get_kucoin_account_summary(kucoin_client: AsyncKuCoinClient):
+    r_kucoin_account = await kucoin_client.get_account_summary()
     kucoin_summary = {}
     for currency_data in r_kucoin_account["data"]:
         currency_name = currency_data["currency"]
@@ -168,17 +212,22 @@ def get_account(
                 }
     currencies_kucoin: List[str] = list(kucoin_summary.keys())
 
-    r_currencies_price_kucoin = kucoin_client.get_symbol_price(
+    r_currencies_price_kucoin = await kucoin_client.get_symbol_price(
         symbols=currencies_kucoin
     )
 
     for currencie_name in kucoin_summary.keys():
-        kucoin_summary[currencie_name]["price"] = r_currencies_price_kucoin["data"][
+        kucoin_summary[currencie_name]["price"] = r_currencies_price_kucoin[
             currencie_name
         ]
+    return kucoin_summary
+
 
-    # ic(r_currencies_price_kucoin)
-    r_mexc_account = mexc_client.get_account_summary()
+async def get_mexc_account_summary(mexc_client: AsyncMexcClient):
+    # the account and the ticker prices do not depend on each other
+    r_mexc_account, r_currencies_price_mexc = await asyncio.gather(
+        mexc_client.get_account_summary(), mexc_client.get_symbol_price()
+    )
     mexc_summary = {}
     for currency_data in r_mexc_account["balances"]:
         currency_name = currency_data["asset"]
@@ -190,18 +239,26 @@ def get_account(
                     "account_Type": r_mexc_account["accountType"],
                 }
 
-    r_currencies_price_mexc = mexc_client.get_symbol_price()
-    # filter existing currencies in the mexc account
-
-    currencies_price_mexc = {
-        c["symbol"]: {"price": c["price"]} for c in r_currencies_price_mexc
-    }
     for currencie_name in mexc_summary.keys():
-        if currencie_name in mexc_summary.keys():
-            mexc_summary[currencie_name]["price"] = currencies_price_mexc[
-                currencie_name + "USDT"
-            ]["price"]
-    # ic(r_currencies_price_mexc)
+        mexc_summary[currencie_name]["price"] = r_currencies_price_mexc[
+            currencie_name + "USDT"
+        ]
+    return mexc_summary
+
+
+@router.get("/account")
+async def get_account(
+    kucoin_client: AsyncKuCoinClient = Depends(get_async_kucoin_client),
+    mexc_client: AsyncMexcClient = Depends(get_async_mexc_client),
+):
+    # both exchanges are queried at the same time, so the latency is the
+    # one of the slowest exchange instead of the sum of both
+    kucoin_summary, mexc_summary = await asyncio.gather(
+        exchange_or_empty(
+            kucoin_client.name, get_kucoin_account_summary(kucoin_client)
+        ),
+        exchange_or_empty(mexc_client.name, get_mexc_account_summary(mexc_client)),
+    )
     return {
         kucoin_client.name: kucoin_summary,
         mexc_client.name: mexc_summary,
@@ -241,59 +298,27 @@ def load_klines_from_drive(drive_service, file_id):
     return df
 
 
-def calculate_dates_for_exchange_request(
-    existing_start_date, existing_end_date, start_date, end_date
-):
-    if existing_start_date <= start_date and existing_end_date >= end_date:
-        ic("all data in the csv")
-
-        return None, None
-    elif existing_start_date < start_date and existing_end_date < end_date:
-        ic("need to request data after")
-        # calculate delta btw existing_end_date and end_date
-        delta_date = end_date - existing_end_date
-
-        return existing_end_date, end_date
-    elif existing_start_date > start_date and existing_end_date > end_date:
-        ic("need to request data before")
-        return start_date, existing_start_date
-    elif existing_start_date > start_date and existing_end_date < end_date:
-        ic("need to request data before and after")
-        return start_date, end_date
-    elif existing_start_date < start_date and existing_end_date > end_date:
-        ic("need to request data before and after")
-        return existing_end_date, existing_start_date
-    else:
-        ic("invalid date range")
-        return None, None
-
-
 def delete_drive_file(drive_service, file_id):
     drive_service.files().delete(fileId=file_id).execute()
 
 
-@router.get("/klines")
-def get_symbol_klines(
-    request: Request,
-    exchange: str,
-    symbol: str,
-    pair: str,
-    interval: str,
-    start_at: int = None,
-    end_at: int = None,
-    db=Depends(get_db),
-) -> List[KlinesBase]:
+# ids of the series already looked up, they never change once created
+kline_series: Dict[tuple, KlineSeries] = {}
+
+
+def get_kline_series(
+    db, exchange: str, symbol: str, pair: str, interval: str
+) -> KlineSeries:
+    key = (exchange, symbol, pair, interval)
+    if key in kline_series:
+        return kline_series[key]
     exchange_db = db.query(Exchange).filter(Exchange.name == exchange).first()
-    crypto_exchange_client: KuCoinClient | MexcClient = (
-        request.app.state.crypto_clients[exchange_db.name]
-    )
     logger.info(f"exchange_db: {exchange_db.name}")
     pair_db = (
         db.query(Pair)
         .filter(Pair.exchange_id == exchange_db.id, Pair.name == pair)
         .first()
     )
-
     symbol_db = (
         db.query(Symbol)
         .filter(
@@ -302,6 +327,8 @@ def get_symbol_klines(
             Symbol.pair_id == pair_db.id,
         )
         .first()
+        if pair_db
+        else None
     )
     # check if symbol and pair exists
     if not symbol_db:
@@ -316,43 +343,164 @@ def get_symbol_klines(
     if not interval_db:
         raise HTTPException(status_code=404, detail="Interval not found")
 
-    klines_filters = [
-        Kline.symbol_id == symbol_db.id,
-        Kline.interval_id == interval_db.id,
-    ]
+    kline_series[key] = KlineSeries(
+        exchange=exchange_db.name,
+        symbol=symbol,
+        pair=pair,
+        interval=interval,
+        symbol_id=symbol_db.id,
+        interval_id=interval_db.id,
+    )
+    return kline_series[key]
+
 
-    if start_at:
-        klines_filters.append(Kline.time >= str(start_at))
-    if end_at:
-        klines_filters.append(Kline.time <= str(end_at))
-    klines: List[Kline] = db.query(Kline).filter(*klines_filters).all()
-    if klines:
-        return klines
-    else:
-        # trigger a celery task to get the klines
-        
-    # klines to dataframe
-    # df = [
-    #         {
-    #             "time": k.time,
-    #             "open": k.open,
-    #             "high": k.high,
-    #             "low": k.low,
-    #             "close": k.close,
-    #             "volume": k.volume,
-    #         }
-    #         for k in klines
-    #     ]
+@router.get("/klines")
+def get_symbol_klines(
+    request: Request,
+    exchange: str,
+    symbol: str,
+    pair: str,
+    interval: str,
+    start_at: int = None,
+    end_at: int = None,
+    stream: str = None,
+    max_points: int = None,
+    downsample: str = "ohlc",
+    db=Depends(get_db),
+) -> List[KlinesBase]:
+    # stream=ndjson, arrow or codec sends the klines in chunks as they are read
+    # max_points bounds the klines returned, downsampled with ohlc buckets or lttb
+    if stream is not None and stream not in STREAM_FORMATS:
+        raise HTTPException(
+            status_code=400, detail=f"stream must be one of {list(STREAM_FORMATS)}"
+        )
+    if stream == "arrow" and pa is None:
+        raise HTTPException(status_code=400, detail="arrow streaming needs pyarrow")
+    if downsample not in DOWNSAMPLE_MODES:
+        raise HTTPException(
+            status_code=400,
+            detail=f"downsample must be one of {list(DOWNSAMPLE_MODES)}",
+        )
+    if max_points is not None and max_points < 1:
+        raise HTTPException(status_code=400, detail="max_points must be positive")
+    series = get_kline_series(db, exchange, symbol, pair, interval)
+    crypto_exchange_client: KuCoinClient | MexcClient = (
+        request.app.state.crypto_clients[series.exchange]
+    )
+    store = get_kline_store(db)
+    coverage = KlineCoverageIndex(db)
+    klines = None
+    if start_at is not None:
+        # end_at is inclusive
+        now = int(datetime.now().timestamp())
+        range_end = end_at + 1 if end_at is not None else now
+        # a range read before is served from the cache without the database
+        klines = store.cached(series, start_at, range_end - 1)
+    if klines is None and start_at is not None:
+        interval_ids = {
+            it.name: it.id
+            for it in db.query(Interval)
+            .join(Exchange, Exchange.id == Interval.exchange_id)
+            .filter(Exchange.name == series.exchange)
+        }
+        # a finer interval already stored for the whole range is aggregated
+        # instead of downloading this one
+        klines = resample_stored_klines(
+            store,
+            coverage,
+            crypto_exchange_client.planner,
+            series,
+            interval_ids,
+            start_at,
+            range_end,
+            now,
+        )
+    if klines is None and start_at is not None:
+        # only the parts of the range that were never stored are downloaded
+        try:
+            fetch_missing_klines(
+                crypto_exchange_client, store, coverage, series, start_at, range_end
+            )
+        except (ExchangeError, httpx.HTTPError) as e:
+            logger.error(f"{exchange} klines unavailable, serving stored ones: {e}")
+    if klines is None and (stream is None or max_points is not None):
+        klines = store.read(
+            series, start_at, range_end - 1 if start_at is not None else end_at
+        )
+    if max_points is not None:
+        klines = downsample_klines(klines, max_points, downsample)
+    if stream is not None:
+        if klines is not None:
+            chunks = split_klines(klines, KLINE_CHUNK_SIZE)
+        else:
+            chunks = store.iter_read(series, start_at, end_at)
+        return StreamingResponse(
+            encode_chunks(stream, chunks), media_type=STREAM_FORMATS[stream]
+        )
+    if not len(klines) and start_at is None:
+        # nothing stored yet, trigger a celery task to get the klines
+        backfill_symbol_klines.delay(exchange, symbol, pair, interval)
+    klines = klines.to_frame().to_dict("records")
     return klines
 
 
 @router.get("/klines/all")
-def get_klines(exchange: str, symbol: str, base: str, interval: str):
+def get_klines(
+    exchange: str,
+    symbol: str,
+    base: str,
+    interval: str,
+    start_at: int = None,
+    end_at: int = None,
+):
     # start celery task to get all klines for a interval and symbol
-    task = get_symbol_klines_task.apply_async(args=[exchange, symbol, base, interval])
+    task = backfill_symbol_klines.apply_async(
+        args=[exchange, symbol, base, interval, start_at, end_at]
+    )
     return {"task_id": task.id, "status": "started"}
 
 
+@router.get("/klines/all/{task_id}")
+def get_klines_progress(task_id: str):
+    # done/total chunks of a backfill started by /klines/all
+    return backfill_progress(task_id)
+
+
+@router.get("/klines/follow")
+def get_followed_klines(request: Request, db=Depends(get_db)):
+    watermarks = KlineWatermarks(db)
+    return [
+        {
+            "exchange": series.exchange,
+            "symbol": series.symbol,
+            "pair": series.pair,
+            "interval": series.interval,
+            "watermark": watermark,
+        }
+        for exchange in request.app.state.crypto_clients
+        for series, watermark in watermarks.tracked(exchange)
+    ]
+
+
+@router.post("/klines/follow")
+def follow_symbol_klines(
+    exchange: str, symbol: str, pair: str, interval: str, db=Depends(get_db)
+):
+    # the follow beat task keeps the klines of the series current
+    series = get_kline_series(db, exchange, symbol, pair, interval)
+    KlineWatermarks(db).track(series)
+    return {"status": "following"}
+
+
+@router.delete("/klines/follow")
+def unfollow_symbol_klines(
+    exchange: str, symbol: str, pair: str, interval: str, db=Depends(get_db)
+):
+    series = get_kline_series(db, exchange, symbol, pair, interval)
+    KlineWatermarks(db).untrack(series)
+    return {"status": "not following"}
+
+
 @router.get("/trades")
 def get_trades(
     drive_service=Depends(get_drive_service),
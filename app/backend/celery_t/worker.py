@@ -1,15 +1,39 @@
-from datetime import datetime, timedelta
+from dataclasses import asdict
+import json
 import os
 import time
+from typing import List
 from celery.schedules import crontab
-from celery import Celery
-from backend.api.core.exchanges_clients import KuCoinClient, MexcClient
+from celery import Celery, chord
+from celery.exceptions import Ignore
+from celery.result import GroupResult
+from backend.api.core.client_registry import CLIENT_CLASSES, ExchangeClientRegistry
+from backend.api.core.kline_backfill import (
+    KLINE_BACKFILL_RETRIES,
+    backfill_chunks,
+    backfill_start,
+)
+from backend.api.core.kline_coverage import (
+    KLINE_DOWNLOAD_CONCURRENCY,
+    KlineCoverageIndex,
+)
+from backend.api.core.kline_follow import (
+    ASYNC_CLIENT_CLASSES,
+    KlineWatermarks,
+    follow_klines,
+)
+from backend.api.core.kline_partitions import maintain_partitions
+from backend.api.core.kline_store import KlineSeries, get_kline_store
+from backend.api.core.resilience import ExchangeError
+from backend.api.core.symbol_catalog import insert_symbol_pairs
+from backend.api.core.symbol_registry import SymbolRegistry, fingerprint_payload
 from backend.api.routers.github_api import GitHubClient
 from backend.config import GITHUB_ACCESS_TOKEN, SQLALCHEMY_DATABASE_URL
 import httpx
+import redis
 from celery.signals import worker_process_init, worker_process_shutdown
 from backend.api import database
-from backend.api.models.crypto import Exchange, Pair, Symbol, Interval, Kline
+from backend.api.models.crypto import Exchange, Pair, Symbol, Interval
 import logging
 
 logger = logging.getLogger(__name__)
@@ -39,21 +63,35 @@ celery.conf.worker_logger_name = "celery.worker"
 # Example usage
 
 db_conn = None
+exchange_clients: ExchangeClientRegistry = None
 
 
 @worker_process_init.connect
 def init_worker(**kwargs):
-    global db_conn
+    global db_conn, exchange_clients
     print("Initializing database connection for worker.")
     db_conn = database.get_db()
+    print("Initializing exchange clients for worker.")
+    exchange_clients = ExchangeClientRegistry()
 
 
 @worker_process_shutdown.connect
 def shutdown_worker(**kwargs):
-    global db_conn
     if db_conn:
         print("Closing database connectionn for worker.")
         db_conn.close()
+    if exchange_clients:
+        print("Closing exchange connections for worker.")
+        exchange_clients.close()
+
+
+def get_exchange_client(exchange: Exchange):
+    # worker_process_init only runs for prefork children, other pools
+    # create the registry on first use
+    global exchange_clients
+    if exchange_clients is None:
+        exchange_clients = ExchangeClientRegistry()
+    return exchange_clients.get(exchange)
 
 
 @celery.on_after_configure.connect
@@ -63,11 +101,21 @@ def setup_periodic_tasks(sender, **kwargs):
         get_exchanges_symbols.s(),
         expires=10,
     )
+    sender.add_periodic_task(
+        crontab(),  # executes every minute
+        follow_tracked_klines.s(),
+        expires=50,
+    )
     sender.add_periodic_task(
         crontab(minute=0, hour="*/3"),  # executes every 3 hours
         get_github_repos.s(),
         expires=10,
     )
+    sender.add_periodic_task(
+        crontab(minute=30, hour=0),  # executes every day
+        maintain_kline_partitions.s(),
+        expires=3600,
+    )
 
 
 @celery.task(name="github_info")
@@ -79,164 +127,228 @@ def get_github_repos():
     return True
 
 
-@celery.task(name="get_symbol_klines")
-def get_symbol_klines(exchange: str, symbol: str, base: str, interval: str):
+@celery.task(name="maintain_kline_partitions")
+def maintain_kline_partitions():
+    maintain_partitions(database.engine)
+
+
+@celery.task(name="follow_klines")
+def follow_tracked_klines():
+    # only the candles since each followed series' watermark are fetched
     db = database.get_db()
-    # make requests to exchange client and get klines until finding the last kline
-    exchange = db.query(Exchange).filter(Exchange.name == exchange).first()
-    if exchange.name == "KuCoin":
-        kucoin_client = KuCoinClient(
-            id=exchange.id,
-            api_key=exchange.api_key,
-            api_secret=exchange.secret_key,
-            passphrase=exchange.passphrase,
-            base_url=exchange.base_url,
-        )
+    store = get_kline_store(db)
+    coverage = KlineCoverageIndex(db)
+    watermarks = KlineWatermarks(db)
+    exchanges = db.query(Exchange).filter(Exchange.name.in_(ASYNC_CLIENT_CLASSES))
+    for exchange in exchanges.all():
+        follow_klines(exchange, store, coverage, watermarks)
+    db.close()
 
-        symbol_db: Symbol = (
-            db.query(Symbol)
-            .filter(Symbol.symbol == symbol, Symbol.base_asset == base)
-            .first()
-        )
-        interval_db: Interval = (
-            db.query(Interval)
-            .filter(Interval.exchange_id == exchange.id, Interval.interval == interval)
-            .first()
+
+@celery.task(name="exchange_pool_stats")
+def exchange_pool_stats():
+    if exchange_clients is None:
+        return {}
+    return exchange_clients.stats()
+
+
+def load_kline_series(
+    db, exchange: Exchange, symbol: str, pair: str, interval: str
+) -> KlineSeries:
+    pair_db: Pair = (
+        db.query(Pair)
+        .filter(Pair.exchange_id == exchange.id, Pair.name == pair)
+        .first()
+    )
+    symbol_db: Symbol = (
+        db.query(Symbol)
+        .filter(
+            Symbol.exchange_id == exchange.id,
+            Symbol.name == symbol,
+            Symbol.pair_id == pair_db.id,
         )
-        # valid interval
-        exchange_symbol = kucoin_client.build_symbol_pair(symbol_db)
-        # iterate in past to find the last kline
-        # if there is already data in the database, then start from the last kline
-        last_kline = (
-            db.query(Kline)
-            .filter(
-                Kline.symbol_id == symbol_db.id, Kline.interval_id == interval_db.id
-            )
-            .order_by(Kline.time.asc())
-            .first()
+        .first()
+    )
+    interval_db: Interval = (
+        db.query(Interval)
+        .filter(Interval.exchange_id == exchange.id, Interval.name == interval)
+        .first()
+    )
+    return KlineSeries(
+        exchange=exchange.name,
+        symbol=symbol,
+        pair=pair,
+        interval=interval_db.name,
+        symbol_id=symbol_db.id,
+        interval_id=interval_db.id,
+    )
+
+
+@celery.task(name="backfill_symbol_klines", bind=True)
+def backfill_symbol_klines(
+    self,
+    exchange: str,
+    symbol: str,
+    pair: str,
+    interval: str,
+    start_at: int = None,
+    end_at: int = None,
+):
+    # the missing parts of the range are split into chunks downloaded by
+    # independent subtasks on any worker, all under the exchange rate limit.
+    # The task stays in PROGRESS until the chord callback stores the totals
+    db = database.get_db()
+    exchange_db = db.query(Exchange).filter(Exchange.name == exchange).first()
+    series = load_kline_series(db, exchange_db, symbol, pair, interval)
+    now = int(time.time())
+    start = start_at if start_at is not None else backfill_start()
+    end = min(end_at + 1, now) if end_at is not None else now
+    planner = get_exchange_client(exchange_db).planner
+    chunks = backfill_chunks(planner, KlineCoverageIndex(db), series, start, end)
+    db.close()
+    logger.info(f"{symbol}-{pair} {interval}: backfill of {len(chunks)} chunks")
+    if not chunks:
+        return {"done": 0, "total": 0, "klines": 0}
+    result = chord(
+        backfill_kline_chunk.s(asdict(series), chunk_start, chunk_end)
+        for chunk_start, chunk_end in chunks
+    )(finish_kline_backfill.s(self.request.id, asdict(series)))
+    # the header group is looked up again by backfill_progress
+    result.parent.save()
+    self.update_state(
+        state="PROGRESS",
+        meta={"group_id": result.parent.id, "done": 0, "total": len(chunks)},
+    )
+    raise Ignore()
+
+
+@celery.task(
+    name="backfill_kline_chunk",
+    autoretry_for=(ExchangeError, httpx.HTTPError),
+    retry_backoff=True,
+    max_retries=KLINE_BACKFILL_RETRIES,
+)
+def backfill_kline_chunk(series: dict, start: int, end: int) -> int:
+    series = KlineSeries(**series)
+    db = database.get_db()
+    try:
+        exchange = db.query(Exchange).filter(Exchange.name == series.exchange).first()
+        client = get_exchange_client(exchange)
+        klines = client.get_symbol_kline_arrays(
+            client.build_symbol_pair(series.symbol, series.pair),
+            series.interval,
+            start,
+            end,
+            concurrency=KLINE_DOWNLOAD_CONCURRENCY,
         )
+        # an error answer raised above, the range is not covered
+        get_kline_store(db).write(series, klines)
+        # the still open candle is left out of the coverage
+        current_open = client.planner.align(int(time.time()), series.interval)
+        KlineCoverageIndex(db).add(series, start, min(end, current_open))
+    finally:
+        db.close()
+    return len(klines)
+
 
-        if last_kline:
-            start_date = datetime.fromtimestamp(int(last_kline.time))
+@celery.task(name="finish_kline_backfill")
+def finish_kline_backfill(counts: List[int], task_id: str, series: dict):
+    series = KlineSeries(**series)
+    result = {"done": len(counts), "total": len(counts), "klines": sum(counts)}
+    celery.backend.store_result(task_id, result, "SUCCESS")
+    logger.info(
+        f"{series.symbol}-{series.pair} {series.interval}: backfill done, "
+        f"{result['klines']} klines in {len(counts)} chunks"
+    )
+
+
+def backfill_progress(task_id: str) -> dict:
+    result = backfill_symbol_klines.AsyncResult(task_id)
+    progress = {"task_id": task_id, "status": result.state}
+    info = result.info if isinstance(result.info, dict) else {}
+    if result.state == "PROGRESS" and "group_id" in info:
+        chunks = GroupResult.restore(info["group_id"], app=celery)
+        if chunks is None:
+            # the backend drops the group once the chord completes
+            info["done"] = info["total"]
         else:
-            start_date = datetime.now()
-        end_date = start_date - timedelta(days=5)
-
-        start_date = int(start_date.timestamp())
-        end_date = int(end_date.timestamp())
-
-        while start_date > end_date:
-            logger.info(
-                str(datetime.fromtimestamp(start_date)),
-                str(datetime.fromtimestamp(end_date)),
-            )
-            try:
-                klines = kucoin_client.get_symbol_kline(
-                    symbol=exchange_symbol,
-                    interval=interval_db.interval,
-                    start_at=start_date,
-                    end_at=end_date,
-                )
-                last_kline = klines[-1]
-            except Exception as e:
-                logging.error(e)
-                time.sleep(5)
-                break
-
-            start_date = int(last_kline["time"])
-            # if 2 consequtive start_dates are the same, then we are in an infinite loop
-            end_date = int(
-                (datetime.fromtimestamp(start_date) - timedelta(days=5)).timestamp()
-            )  # one day before
-
-            logger.info(start_date)
-            logger.info(end_date)
-            for kline in klines:
-                db.add(
-                    Kline(
-                        symbol_id=symbol_db.id,
-                        interval_id=interval_db.id,
-                        time=kline["time"],
-                        open=kline["open"],
-                        high=kline["high"],
-                        low=kline["low"],
-                        close=kline["close"],
-                        volume=kline["volume"],
-                        quote_asset_volume=None,
-                    )
-                )
-        db.commit()
+            info["done"] = chunks.completed_count()
+            info["failed"] = len([r for r in chunks.results if r.failed()])
+            if info["failed"] and chunks.ready():
+                # a chunk ran out of retries, the callback never runs
+                progress["status"] = "FAILURE"
+    progress.update(
+        {key: info[key] for key in ("done", "total", "failed", "klines") if key in info}
+    )
+    return progress
 
 
-@celery.task(name="get_exchanges_symbols")
-def get_exchanges_symbols():
-    db = database.get_db()
-    news_symbols = 0
-    kucoin_exchange = db.query(Exchange).filter(Exchange.name == "KuCoin").first()
-    kucoin_client = KuCoinClient(
-        id=kucoin_exchange.id,
-        name=kucoin_exchange.name,
-        api_key=kucoin_exchange.api_key,
-        api_secret=kucoin_exchange.secret_key,
-        passphrase=kucoin_exchange.passphrase,
-        base_url=kucoin_exchange.base_url,
+def sync_exchange_symbols(db, exchange: Exchange, registry: SymbolRegistry) -> dict:
+    exchange_client = get_exchange_client(exchange)
+    payload = exchange_client.get_all_symbols_payload()
+    fingerprint = fingerprint_payload(payload)
+    try:
+        if fingerprint == registry.fingerprint(exchange.name):
+            logger.info(f"{exchange.name} symbols unchanged")
+            return {"changed": False}
+        symbols = exchange_client.parse_symbol_pairs(json.loads(payload))
+        added, removed = registry.diff(exchange.name, symbols)
+    except redis.RedisError as e:
+        # without the registry every listed symbol goes to the database,
+        # insert_symbol_pairs skips the ones already stored
+        logger.error(f"{exchange.name} symbol registry unavailable: {e}")
+        symbols = exchange_client.parse_symbol_pairs(json.loads(payload))
+        added, removed, registry = symbols, set(), None
+
+    started = time.perf_counter()
+    news_symbols = insert_symbol_pairs(db, exchange.id, added)
+    db_seconds = time.perf_counter() - started
+    # delisted symbols leave the catalog but keep their rows and klines
+    if registry is not None:
+        registry.update(exchange.name, fingerprint, added, removed)
+    logger.info(
+        f"{exchange.name} news_symbols: {news_symbols} "
+        f"added: {len(added)} removed: {len(removed)} "
+        f"db: {db_seconds * 1000:.1f}ms"
     )
-    kucoin_symbols = kucoin_client.get_all_symbols()
-
-    for symbol, pair in kucoin_symbols.items():
-        # check if pair exists in the database
-        pair_db = (
-            db.query(Pair)
-            .filter(Pair.exchange_id == kucoin_exchange.id, Pair.name == pair)
-            .first()
-        )
-        if not pair_db:
-            # pair does not exist, add it
-            pair_db = Pair(exchange_id=kucoin_exchange.id, name=pair)
-            db.add(pair_db)
-            db.commit()
-        if (
-            not db.query(Symbol)
-            .filter(Symbol.name == symbol, Symbol.pair_id == pair_db.id)
-            .first()
-        ):
-            news_symbols += 1
-            db.add(
-                Symbol(exchange_id=kucoin_exchange.id, name=symbol, pair_id=pair_db.id)
-            )
-    db.commit()
-    logger.info(f"{kucoin_exchange.name} news_symbols: {news_symbols}")
-    news_symbols = 0
-    mexc_exchange = db.query(Exchange).filter(Exchange.name == "MEXC").first()
-    mexc_client = MexcClient(
-        mexc_exchange.id,
-        mexc_exchange.name,
-        mexc_exchange.api_key,
-        mexc_exchange.secret_key,
-        mexc_exchange.base_url,
+    return {
+        "changed": True,
+        "new_symbols": news_symbols,
+        "added": len(added),
+        "removed": len(removed),
+        "db_ms": round(db_seconds * 1000, 1),
+    }
+
+
+@celery.task(name="sync_exchange_symbols", expires=50)
+def sync_exchange_symbols_task(exchange_name: str) -> dict:
+    started = time.perf_counter()
+    db = database.get_db()
+    try:
+        exchange = db.query(Exchange).filter(Exchange.name == exchange_name).first()
+        metrics = sync_exchange_symbols(db, exchange, SymbolRegistry())
+    finally:
+        db.close()
+    metrics["exchange"] = exchange_name
+    metrics["seconds"] = round(time.perf_counter() - started, 3)
+    logger.info(f"{exchange_name} symbols synced in {metrics['seconds']}s")
+    return metrics
+
+
+@celery.task(name="symbol_sync_done")
+def symbol_sync_done(results: List[dict], started: float):
+    # the exchanges ran in parallel, the run took as long as the slowest one
+    slowest = max(results, key=lambda r: r["seconds"])
+    logger.info(
+        f"symbols of {len(results)} exchanges synced in "
+        f"{time.time() - started:.3f}s, slowest {slowest['exchange']} "
+        f"{slowest['seconds']}s"
     )
-    logger.info(mexc_client)
-    mexc_symbols = mexc_client.get_all_symbols()
-    for symbol, pair in mexc_symbols.items():
-        pair_db = (
-            db.query(Pair)
-            .filter(Pair.exchange_id == mexc_exchange.id, Pair.name == pair)
-            .first()
-        )
-        if not pair_db:
-            # pair does not exist, add it
-            pair_db = Pair(exchange_id=mexc_exchange.id, name=pair)
-            db.add(pair_db)
-            db.commit()
-        if (
-            not db.query(Symbol)
-            .filter(Symbol.name == symbol, Symbol.pair_id == pair_db.id)
-            .first()
-        ):
-            news_symbols += 1
-            db.add(
-                Symbol(exchange_id=mexc_exchange.id, name=symbol, pair_id=pair_db.id)
-            )
-    db.commit()
-    logger.info(f"{mexc_exchange.name} news_symbols: {news_symbols}")
-    db.close()
+
+
+@celery.task(name="get_exchanges_symbols")
+def get_exchanges_symbols():
+    # one task per exchange, a slow exchange does not delay the others
+    chord(
+        sync_exchange_symbols_task.s(exchange_name) for exchange_name in CLIENT_CLASSES
+    )(symbol_sync_done.s(time.time()))
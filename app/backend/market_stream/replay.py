@@ -0,0 +1,64 @@
+import argparse
+import asyncio
+import json
+import logging
+from typing import List
+
+import websockets
+
+logger = logging.getLogger(__name__)
+
+
+def load_frames(path: str) -> List[dict]:
+    # files written by `stream.py --record`, one {"t": seconds, "frame": str} per line
+    with open(path) as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+class ReplayServer:
+    # plays recorded exchange frames to every client that connects, so the
+    # ingestion can be run offline with `stream.py --url ws://localhost:8765`
+
+    def __init__(self, frames: List[dict], speed: float = 1.0):
+        self.frames = frames
+        self.speed = speed
+
+    async def drain(self, websocket):
+        # pings and further subscriptions are accepted and ignored
+        try:
+            async for message in websocket:
+                logger.debug(f"replay received {message}")
+        except websockets.ConnectionClosed:
+            pass
+
+    async def handler(self, websocket, *args):
+        # like the exchanges, nothing is sent before the first subscription
+        await websocket.recv()
+        drain = asyncio.create_task(self.drain(websocket))
+        previous = 0.0
+        for frame in self.frames:
+            if self.speed > 0:
+                await asyncio.sleep(max(frame["t"] - previous, 0) / self.speed)
+            previous = frame["t"]
+            await websocket.send(frame["frame"])
+        logger.info(f"replayed {len(self.frames)} frames")
+        # keep the connection open until the client leaves
+        await drain
+
+    async def serve(self, host: str, port: int):
+        async with websockets.serve(self.handler, host, port):
+            logger.info(f"replay server listening on ws://{host}:{port}")
+            await asyncio.Future()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="replay recorded market frames")
+    parser.add_argument("frames", help="file recorded with stream.py --record")
+    parser.add_argument("--host", default="localhost")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--speed", type=float, default=1.0, help="0 for no delay")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+
+    server = ReplayServer(load_frames(args.frames), speed=args.speed)
+    asyncio.run(server.serve(args.host, args.port))
@@ -0,0 +1,374 @@
+import argparse
+import asyncio
+import json
+import logging
+import os
+import time
+from typing import Dict, List, Tuple
+from uuid import uuid4
+
+import httpx
+import websockets
+
+import numpy as np
+
+from backend.api import database
+from backend.api.core.kline_arrays import KLINE_COLUMNS, KlineArrays
+from backend.api.core.kline_coverage import KlineCoverageIndex
+from backend.api.core.kline_follow import KlineWatermarks
+from backend.api.core.kline_planner import KlineRangePlanner
+from backend.api.core.kline_store import KlineSeries, get_kline_store
+from backend.api.core.price_cache import STREAM_PRICES_KEY
+from backend.api.core.redis_client import get_redis_client
+from backend.api.models.crypto import Exchange, Interval, Pair, Symbol
+
+logger = logging.getLogger(__name__)
+
+MEXC_WS_URL = os.environ.get("MEXC_WS_URL", "wss://wbs.mexc.com/ws")
+RECONNECT_DELAY = 5
+# seconds the streamed prices outlive the last price update
+STREAM_PRICES_TTL = int(os.environ.get("STREAM_PRICES_TTL", 60))
+
+
+class CandleTracker:
+    # the streams push the candle that is still open on every trade, a candle
+    # is finished once the first update of the next candle arrives
+
+    def __init__(self):
+        self.open_candles: Dict[Tuple[str, str], dict] = {}
+
+    def update(self, symbol: str, interval: str, kline: dict) -> dict | None:
+        key = (symbol, interval)
+        previous = self.open_candles.get(key)
+        self.open_candles[key] = kline
+        if previous is not None and kline["time"] > previous["time"]:
+            return previous
+        return None
+
+
+class ExchangeStream:
+    name = None
+    ping_interval = 20
+
+    def __init__(self, symbols: List[str], interval: str, url: str = None):
+        self.symbols = symbols
+        self.interval = interval
+        self.url = url
+        self.candles = CandleTracker()
+
+    async def connect_url(self) -> str:
+        return self.url
+
+    def exchange_symbol(self, symbol: str, pair: str) -> str:
+        raise NotImplementedError
+
+    def subscribe_messages(self) -> List[dict]:
+        raise NotImplementedError
+
+    def ping_message(self) -> dict:
+        raise NotImplementedError
+
+    def price_key(self, symbol: str) -> str | None:
+        """key of the exchange client price snapshot the price replaces"""
+        return symbol
+
+    def parse(self, message: dict) -> Tuple[List[tuple], List[tuple]]:
+        """returns the finished klines (symbol, kline) and prices (symbol, price)"""
+        raise NotImplementedError
+
+
+class KuCoinStream(ExchangeStream):
+    name = "KuCoin"
+
+    def __init__(self, symbols, interval, url=None, base_url=None):
+        super().__init__(symbols, interval, url)
+        self.base_url = base_url
+
+    async def connect_url(self) -> str:
+        if self.url:
+            return self.url
+        # kucoin hands out the websocket server and a token per connection
+        async with httpx.AsyncClient() as client:
+            r = await client.post(self.base_url + "/api/v1/bullet-public")
+        data = r.json()["data"]
+        server = data["instanceServers"][0]
+        self.ping_interval = server["pingInterval"] / 1000
+        return f"{server['endpoint']}?token={data['token']}&connectId={uuid4()}"
+
+    def exchange_symbol(self, symbol: str, pair: str) -> str:
+        return f"{symbol}-{pair}"
+
+    def price_key(self, symbol: str) -> str | None:
+        # the client prices are USD by currency, the USDT ticker stands in
+        currency, pair = symbol.split("-")
+        return currency if pair == "USDT" else None
+
+    def subscribe_messages(self) -> List[dict]:
+        messages = [
+            {
+                "id": str(uuid4()),
+                "type": "subscribe",
+                "topic": f"/market/candles:{symbol}_{self.interval}",
+                "privateChannel": False,
+                "response": True,
+            }
+            for symbol in self.symbols
+        ]
+        messages.append(
+            {
+                "id": str(uuid4()),
+                "type": "subscribe",
+                "topic": f"/market/ticker:{','.join(self.symbols)}",
+                "privateChannel": False,
+                "response": True,
+            }
+        )
+        return messages
+
+    def ping_message(self) -> dict:
+        return {"id": str(uuid4()), "type": "ping"}
+
+    def parse(self, message):
+        klines, prices = [], []
+        if message.get("type") != "message":
+            return klines, prices
+        topic, data = message["topic"], message["data"]
+        if topic.startswith("/market/candles:"):
+            candle = data["candles"]
+            kline = {
+                "time": int(candle[0]),
+                "open": float(candle[1]),
+                "close": float(candle[2]),
+                "high": float(candle[3]),
+                "low": float(candle[4]),
+                "volume": float(candle[5]),
+            }
+            closed = self.candles.update(data["symbol"], self.interval, kline)
+            if closed:
+                klines.append((data["symbol"], closed))
+        elif topic.startswith("/market/ticker:"):
+            prices.append((topic.split(":")[1], data["price"]))
+        return klines, prices
+
+
+class MexcStream(ExchangeStream):
+    name = "MEXC"
+    WS_INTERVALS = {
+        "1m": "Min1",
+        "5m": "Min5",
+        "15m": "Min15",
+        "30m": "Min30",
+        "60m": "Min60",
+        "4h": "Hour4",
+        "1d": "Day1",
+        "1W": "Week1",
+        "1M": "Month1",
+    }
+
+    async def connect_url(self) -> str:
+        return self.url or MEXC_WS_URL
+
+    def exchange_symbol(self, symbol: str, pair: str) -> str:
+        return f"{symbol}{pair}"
+
+    def subscribe_messages(self) -> List[dict]:
+        ws_interval = self.WS_INTERVALS[self.interval]
+        params = []
+        for symbol in self.symbols:
+            params.append(f"spot@public.kline.v3.api@{symbol}@{ws_interval}")
+            params.append(f"spot@public.deals.v3.api@{symbol}")
+        return [{"method": "SUBSCRIPTION", "params": params}]
+
+    def ping_message(self) -> dict:
+        return {"method": "PING"}
+
+    def parse(self, message):
+        klines, prices = [], []
+        channel = message.get("c", "")
+        if channel.startswith("spot@public.kline"):
+            k = message["d"]["k"]
+            kline = {
+                "time": int(k["t"]),
+                "open": float(k["o"]),
+                "close": float(k["c"]),
+                "high": float(k["h"]),
+                "low": float(k["l"]),
+                "volume": float(k["v"]),
+            }
+            closed = self.candles.update(message["s"], self.interval, kline)
+            if closed:
+                klines.append((message["s"], closed))
+        elif channel.startswith("spot@public.deals"):
+            deals = message["d"]["deals"]
+            if deals:
+                prices.append((message["s"], deals[-1]["p"]))
+        return klines, prices
+
+
+class MarketDataIngestor:
+    # writes finished candles to the kline store and the latest prices to
+    # the redis hash market_stream:prices:<exchange>. Candles go through the
+    # store so they are upserted and drop the cached blocks they land in, and
+    # are covered so /crypto/klines does not download them again.
+
+    def __init__(self, stream: ExchangeStream, record_path: str = None):
+        self.stream = stream
+        self.db = database.get_db()
+        self.store = get_kline_store(self.db)
+        self.coverage = KlineCoverageIndex(self.db)
+        self.planner = KlineRangePlanner(stream.name)
+        self.redis = get_redis_client()
+        self.record_file = open(record_path, "a") if record_path else None
+        self.started_at = time.monotonic()
+        exchange = (
+            self.db.query(Exchange).filter(Exchange.name == stream.name).first()
+        )
+        interval_id = (
+            self.db.query(Interval.id)
+            .filter(Interval.exchange_id == exchange.id, Interval.name == stream.interval)
+            .scalar()
+        )
+        self.series = self.load_series(exchange, interval_id)
+
+    def load_series(self, exchange: Exchange, interval_id: int) -> Dict[str, KlineSeries]:
+        rows = (
+            self.db.query(Symbol.id, Symbol.name, Pair.name)
+            .join(Pair, Pair.id == Symbol.pair_id)
+            .filter(Symbol.exchange_id == exchange.id)
+            .all()
+        )
+        return {
+            self.stream.exchange_symbol(symbol, pair): KlineSeries(
+                exchange=exchange.name,
+                symbol=symbol,
+                pair=pair,
+                interval=self.stream.interval,
+                symbol_id=symbol_id,
+                interval_id=interval_id,
+            )
+            for symbol_id, symbol, pair in rows
+        }
+
+    def record(self, frame: str):
+        if self.record_file:
+            elapsed = round(time.monotonic() - self.started_at, 3)
+            self.record_file.write(json.dumps({"t": elapsed, "frame": frame}) + "\n")
+
+    def handle(self, frame: str):
+        self.record(frame)
+        klines, prices = self.stream.parse(json.loads(frame))
+        closed: Dict[str, List[dict]] = {}
+        for symbol, kline in klines:
+            if symbol not in self.series:
+                logger.warning(f"{self.stream.name} unknown symbol {symbol}")
+                continue
+            closed.setdefault(symbol, []).append(kline)
+        for symbol, candles in closed.items():
+            series = self.series[symbol]
+            self.store.write(
+                series,
+                KlineArrays(
+                    **{c: np.array([k[c] for k in candles]) for c in KLINE_COLUMNS}
+                ),
+            )
+            for kline in candles:
+                # only finished candles get here, each covers its own span
+                self.coverage.add(
+                    series,
+                    kline["time"],
+                    self.planner.next_open(kline["time"], series.interval),
+                )
+        prices = {
+            self.stream.price_key(symbol): price
+            for symbol, price in prices
+            if self.stream.price_key(symbol)
+        }
+        if prices:
+            key = STREAM_PRICES_KEY.format(self.stream.name)
+            pipeline = self.redis.pipeline()
+            pipeline.hset(key, mapping=prices)
+            pipeline.expire(key, STREAM_PRICES_TTL)
+            pipeline.execute()
+
+    def handle_safely(self, frame: str):
+        # one bad frame or a store/redis hiccup must not drop the connection
+        try:
+            self.handle(frame)
+        except Exception:
+            logger.exception(f"{self.stream.name} frame not handled: {frame[:200]}")
+            self.db.rollback()
+
+    async def keep_alive(self, websocket):
+        while True:
+            await asyncio.sleep(self.stream.ping_interval)
+            await websocket.send(json.dumps(self.stream.ping_message()))
+
+    async def run(self):
+        while True:
+            try:
+                url = await self.stream.connect_url()
+                async with websockets.connect(url) as websocket:
+                    logger.info(f"{self.stream.name} stream connected to {url}")
+                    for message in self.stream.subscribe_messages():
+                        await websocket.send(json.dumps(message))
+                    ping = asyncio.create_task(self.keep_alive(websocket))
+                    try:
+                        async for frame in websocket:
+                            self.handle_safely(frame)
+                    finally:
+                        ping.cancel()
+            except (websockets.ConnectionClosed, OSError) as e:
+                logger.warning(f"{self.stream.name} stream disconnected: {e}")
+            except Exception:
+                # token request, handshake rejected: reconnect, never exit
+                logger.exception(f"{self.stream.name} stream failed")
+            await asyncio.sleep(RECONNECT_DELAY)
+
+
+def tracked_symbols(stream: ExchangeStream) -> List[str]:
+    # the followed series (POST /crypto/klines/follow) of the stream interval
+    db = database.get_db()
+    try:
+        tracked = KlineWatermarks(db).tracked(stream.name)
+    finally:
+        db.close()
+    return sorted(
+        stream.exchange_symbol(series.symbol, series.pair)
+        for series, _ in tracked
+        if series.interval == stream.interval
+    )
+
+
+def build_stream(exchange: str, symbols: List[str], interval: str, url: str = None):
+    if exchange == "KuCoin":
+        db = database.get_db()
+        base_url = (
+            db.query(Exchange.base_url).filter(Exchange.name == "KuCoin").scalar()
+        )
+        return KuCoinStream(symbols, interval, url=url, base_url=base_url)
+    if exchange == "MEXC":
+        return MexcStream(symbols, interval, url=url)
+    raise ValueError(f"no stream for exchange {exchange}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="exchange market data ingestion")
+    parser.add_argument("exchange", choices=["KuCoin", "MEXC"])
+    parser.add_argument(
+        "symbols",
+        nargs="*",
+        help="exchange symbols, BTC-USDT, by default the followed ones",
+    )
+    parser.add_argument("--interval", default=None, help="exchange kline interval")
+    parser.add_argument("--url", default=None, help="websocket url, e.g. replay")
+    parser.add_argument("--record", default=None, help="append frames to file")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+
+    interval = args.interval or {"KuCoin": "1min", "MEXC": "1m"}[args.exchange]
+    stream = build_stream(args.exchange, args.symbols, interval, url=args.url)
+    if not stream.symbols:
+        stream.symbols = tracked_symbols(stream)
+    if not stream.symbols:
+        parser.error(f"no {args.exchange} {interval} series followed, pass symbols")
+    asyncio.run(MarketDataIngestor(stream, record_path=args.record).run())
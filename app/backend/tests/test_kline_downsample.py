@@ -0,0 +1,56 @@
+import numpy as np
+import pytest
+
+from backend.api.core.kline_downsample import lttb_indices
+
+
+def reference_lttb(x, y, max_points):
+    # plain loop version of largest triangle three buckets, same buckets
+    n = len(x)
+    edges = [1 + i * (n - 2) // (max_points - 2) for i in range(max_points - 1)]
+    selected = [0]
+    for i in range(max_points - 2):
+        start, end = edges[i], edges[i + 1]
+        if i + 2 < len(edges):
+            next_start, next_end = edges[i + 1], edges[i + 2]
+            next_x = sum(x[next_start:next_end]) / (next_end - next_start)
+            next_y = sum(y[next_start:next_end]) / (next_end - next_start)
+        else:
+            next_x, next_y = x[-1], y[-1]
+        a = selected[-1]
+        best, best_area = start, -1.0
+        for j in range(start, end):
+            area = abs(
+                (x[a] - next_x) * (y[j] - y[a]) - (x[a] - x[j]) * (next_y - y[a])
+            )
+            if area > best_area:
+                best, best_area = j, area
+        selected.append(best)
+    selected.append(n - 1)
+    return selected
+
+
+@pytest.mark.parametrize("n, max_points", [(1000, 100), (1000, 3), (997, 64), (50, 49)])
+@pytest.mark.parametrize("seed", range(10))
+def test_lttb_matches_reference(n, max_points, seed):
+    rng = np.random.default_rng(seed)
+    x = np.arange(n, dtype=np.int64) * 60
+    y = np.cumsum(rng.normal(size=n))
+    expected = reference_lttb(x.astype(float), y, max_points)
+    assert lttb_indices(x, y, max_points).tolist() == expected
+
+
+def test_lttb_last_bucket_average():
+    # the final point must not pull the last bucket's average
+    x = np.arange(1000)
+    y = np.sin(x / 7)
+    expected = reference_lttb(x.astype(float), y, 100)
+    assert lttb_indices(x, y, 100).tolist() == expected
+
+
+def test_lttb_small_max_points():
+    x = np.arange(10)
+    y = x.astype(float)
+    assert lttb_indices(x, y, 20).tolist() == list(range(10))
+    assert lttb_indices(x, y, 2).tolist() == [0, 9]
+    assert lttb_indices(x, y, 1).tolist() == [9]
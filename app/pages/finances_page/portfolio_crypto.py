@@ -4,6 +4,7 @@ import pandas as pd
 import httpx
 from dateutil import parser
 from datetime import datetime
+from backend.api.core.kline_codec import decode_stream
 from backend.api.models.crypto import ExchangeSymbols
 from config import BASE_API_URL
 import calendar
@@ -13,6 +14,9 @@ import plotly.graph_objects as go
 import plotly.express as px
 import trendln
 
+# candles per chart, longer ranges are downsampled by the api
+CHART_MAX_POINTS = 2000
+
 
 def get_crypto_data():
     r_data = httpx.get(BASE_API_URL + "crypto/all", timeout=10)
@@ -46,11 +50,21 @@ def get_crypto_klines_data(exchange, symbol, pair, interval, start_date, end_dat
             "interval": interval,
             "start_at": start_date,
             "end_at": end_date,
+            "stream": "codec",
+            "max_points": CHART_MAX_POINTS,
         },
     )
-    r_json = r_data.json()
-    if r_json:
-        return pd.read_json(r_json)
+    if not r_data.is_success:
+        # the api answers errors as json, not as a kline stream
+        try:
+            detail = r_data.json().get("detail", r_data.text)
+        except ValueError:
+            detail = r_data.text
+        st.error(f"Klines request failed ({r_data.status_code}): {detail}")
+        return None
+    if r_data.content:
+        return decode_stream(r_data.content).to_frame()
+    st.error("No data found")
     return None
 
 def get_trades():
@@ -298,7 +312,6 @@ def load_crypto_portfolio():
             exchange_option, symbol_option, pair_option, interval, start_date, end_date
         )
         if df is None:
-            st.error("No data found")
             return
         fig = go.Figure(
             data=[